@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import time
+import random
+import argparse
+import yaml
+
+from utils.vtime import now
+from northbound.vsnet.network import Network, BestEffort
+
+def legacy_distrib_besteff(besteffs, max_beff_passes):
+    """
+    Multi-pass best-effort distribution (pre-water-filling Network.distrib_besteff); 
+    reservations skip Link.reserve, which can raise on float round-off here
+    """
+    for besteff in besteffs:
+        for link in besteff.route.links:
+            link.n_besteffs = 0
+            link.beff_bandwidth = link.total_bandwidth*link.beff_frac
+    for besteff in besteffs:
+        for link in besteff.route.links:
+            link.n_besteffs += 1
+
+    total_besteff_shares = [0. for besteff in besteffs]
+    besteff_queue = list(besteffs)
+    n_passes = 0
+    while len(besteff_queue) > 0 and n_passes <= max_beff_passes:
+        finished_besteffs = []
+        for beff_i, besteff in enumerate(besteff_queue):
+            if besteff.route.get_capacity(is_besteff=True) == 0:
+                finished_besteffs.append(besteff)
+                besteff.update(total_besteff_shares[beff_i])
+                for link in besteff.route.links:
+                    link.n_besteffs -= 1
+        for besteff in finished_besteffs:
+            beff_i = besteff_queue.index(besteff)
+            besteff_queue.pop(beff_i)
+            total_besteff_shares.pop(beff_i)
+        new_besteff_shares = [0. for besteff in besteff_queue]
+        for beff_i, besteff in enumerate(besteff_queue):
+            new_besteff_shares[beff_i] = besteff.route.get_capacity(is_besteff=True)
+        for beff_i, besteff in enumerate(besteff_queue):
+            new_beff_share = new_besteff_shares[beff_i]
+            total_besteff_shares[beff_i] += new_beff_share
+            for link in besteff.route.links:
+                link.beff_bandwidth -= new_beff_share
+        n_passes += 1
+
+def random_route_ids(network, n_routes):
+    node_names = list(network.node_names())
+    route_ids = []
+    while len(route_ids) < n_routes:
+        route = network.get_route(*random.sample(node_names, 2))
+        if route:
+            route_ids.append(route.id)
+    return route_ids
+
+def benchmark_legacy(network, route_ids, max_beff_passes):
+    besteffs = []
+    for route_id in route_ids[:-1]:
+        besteff = BestEffort(network, network.get_route_from_id(route_id))
+        besteff.start_time = now()
+        besteffs.append(besteff)
+    legacy_distrib_besteff(besteffs, max_beff_passes)
+    # Time one arrival and one departure
+    besteff = BestEffort(network, network.get_route_from_id(route_ids[-1]))
+    besteff.start_time = now()
+    t_start = time.perf_counter()
+    besteffs.append(besteff)
+    legacy_distrib_besteff(besteffs, max_beff_passes)
+    besteffs.remove(besteff)
+    legacy_distrib_besteff(besteffs, max_beff_passes)
+    return (time.perf_counter() - t_start)/2
+
+def benchmark_water_filling(network, route_ids):
+    for route_id in route_ids[:-1]:
+        BestEffort(network, network.get_route_from_id(route_id)).start()
+    # Time one arrival and one departure
+    besteff = BestEffort(network, network.get_route_from_id(route_ids[-1]))
+    t_start = time.perf_counter()
+    besteff.start()
+    besteff.end()
+    return (time.perf_counter() - t_start)/2
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Benchmark VSNet best-effort bandwidth distribution")
+    cli.add_argument(
+        "-c", "--config", type=str, default="config.yaml", 
+        help="path to config yaml (default: ./config.yaml)"
+    )
+    cli.add_argument(
+        "-n", "--n_besteffs", type=str, default="10,50,100,200,500", 
+        help="comma-separated numbers of active best efforts (default: 10,50,100,200,500)"
+    )
+    cli.add_argument(
+        "--seed", type=int, default=42, 
+        help="random seed used to pick best-effort routes (default: 42)"
+    )
+    args = cli.parse_args()
+
+    with open(args.config, "r") as config_yaml:
+        vsnet_config = yaml.safe_load(config_yaml)["vsnet"]
+
+    print(f"{'n_besteffs':>10} {'legacy [ms/event]':>18} {'water-filling [ms/event]':>25}")
+    for n_besteffs in [int(n) for n in args.n_besteffs.split(",")]:
+        results = []
+        for algo in ["legacy", "water-filling"]:
+            network = Network(
+                vsnet_config["network_json"], 
+                vsnet_config["coordinates_json"], 
+                beff_frac=vsnet_config.get("beff_frac", 0.25)
+            )
+            random.seed(args.seed)
+            route_ids = random_route_ids(network, n_besteffs)
+            if algo == "legacy":
+                max_beff_passes = vsnet_config.get("max_beff_passes", 100)
+                results.append(benchmark_legacy(network, route_ids, max_beff_passes))
+            else:
+                results.append(benchmark_water_filling(network, route_ids))
+        print(f"{n_besteffs:>10} {1e3*results[0]:>18.3f} {1e3*results[1]:>25.3f}")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import time
+import random
+import argparse
+import yaml
+
+from northbound.vsnet.network import Network, Route, INFINITY, distance
+
+def legacy_find_link(network, node_1, node_2):
+    """
+    Linear scan over every link in the topology (pre-adjacency find_links)
+    """
+    links = [link for link in network.links() if set([node_1, node_2]) == set(link.nodes)]
+    links.sort(key=lambda link: link.prio_bandwidth, reverse=True)
+    return links[0]
+
+def legacy_reconstruct_route(network, end_node_name, prev):
+    route = Route()
+    route.end_node = network.get_node(end_node_name)
+    this_node = route.end_node
+    prev_node = prev[this_node.name]
+    while prev_node != None:
+        route.start_node = prev_node
+        route.links.insert(0, legacy_find_link(network, prev_node, this_node))
+        this_node = prev_node
+        prev_node = prev[this_node.name]
+    return route
+
+def legacy_dijkstra(network, start_node_name, end_node_name):
+    """
+    Linear-scan Dijkstra (pre-heap Network.dijkstra)
+    """
+    start_node = network.get_node(start_node_name)
+    dist = {}
+    prev = {}
+    queue = []
+    for node in network.nodes():
+        dist[node.name] = 0 if node == start_node else INFINITY
+        prev[node.name] = None
+        queue.append(node)
+
+    while len(queue) > 0:
+        min_dist = INFINITY
+        min_dist_node = None
+        for node in queue:
+            if dist[node.name] < min_dist:
+                min_dist = dist[node.name]
+                min_dist_node = node
+        if min_dist_node == None:
+            return None
+        this_node = min_dist_node
+        queue.remove(min_dist_node)
+        if this_node.name == end_node_name:
+            return legacy_reconstruct_route(network, end_node_name, prev)
+        for next_node in [n for n in this_node.neighbors if n in queue]:
+            link = legacy_find_link(network, this_node, next_node)
+            alt = dist[this_node.name] + link.length
+            if alt < dist[next_node.name] and dist[this_node.name] != INFINITY:
+                dist[next_node.name] = alt
+                prev[next_node.name] = this_node
+
+def legacy_A_star(network, start_node_name, end_node_name):
+    """
+    Sorted-list A* (pre-heap Network.A_star)
+    """
+    start_node = network.get_node(start_node_name)
+    end_node = network.get_node(end_node_name)
+    h = lambda node: distance(node.lat, end_node.lat, node.lon, end_node.lon)
+    queue = [start_node]
+    prev = {start_node_name: None}
+    g_scores = {start_node_name: 0}
+    f_scores = {start_node_name: h(start_node)}
+    while len(queue) != 0:
+        queue.sort(key=lambda node: f_scores[node.name])
+        this_node = queue.pop(0)
+        if this_node.name == end_node.name:
+            return legacy_reconstruct_route(network, end_node_name, prev)
+        for next_node in this_node.neighbors:
+            g_score = g_scores[this_node.name] + legacy_find_link(network, this_node, next_node).length
+            if next_node.name not in g_scores or g_score < g_scores[next_node.name]:
+                prev[next_node.name] = this_node
+                g_scores[next_node.name] = g_score
+                f_scores[next_node.name] = g_score + h(next_node)
+                if next_node not in queue:
+                    queue.append(next_node)
+
+def benchmark(label, route_algo, pairs):
+    routes = []
+    t_start = time.perf_counter()
+    for start_node_name, end_node_name in pairs:
+        routes.append(route_algo(start_node_name, end_node_name))
+    t_elapsed = time.perf_counter() - t_start
+    print(f"{label:<16} {len(pairs)} routes in {t_elapsed:.4f}s ({1e3*t_elapsed/len(pairs):.3f} ms/route)")
+    return routes
+
+def route_length(route):
+    return sum([link.length for link in route.links]) if route else None
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Benchmark VSNet route finding")
+    cli.add_argument(
+        "-c", "--config", type=str, default="config.yaml", 
+        help="path to config yaml (default: ./config.yaml)"
+    )
+    cli.add_argument(
+        "-n", "--n_routes", type=int, default=200, 
+        help="number of random (src, dst) pairs to route (default: 200)"
+    )
+    cli.add_argument(
+        "--seed", type=int, default=42, 
+        help="random seed used to pick (src, dst) pairs (default: 42)"
+    )
+    args = cli.parse_args()
+
+    with open(args.config, "r") as config_yaml:
+        vsnet_config = yaml.safe_load(config_yaml)["vsnet"]
+
+    t_start = time.perf_counter()
+    network = Network(vsnet_config["network_json"], vsnet_config["coordinates_json"])
+    print(f"Loaded {len(network.nodes())} nodes and {len(network.links())} links in {time.perf_counter() - t_start:.4f}s")
+
+    random.seed(args.seed)
+    node_names = list(network.node_names())
+    pairs = [tuple(random.sample(node_names, 2)) for _ in range(args.n_routes)]
+
+    for label, legacy_algo, new_algo in [
+        ("dijkstra", legacy_dijkstra, network.dijkstra), 
+        ("A_star", legacy_A_star, network.A_star)
+    ]:
+        legacy_routes = benchmark(f"legacy {label}", lambda s, e: legacy_algo(network, s, e), pairs)
+        new_routes = benchmark(f"heap {label}", new_algo, pairs)
+        n_mismatches = 0
+        for legacy_route, new_route in zip(legacy_routes, new_routes):
+            if abs((route_length(legacy_route) or 0) - (route_length(new_route) or 0)) > 1e-6:
+                n_mismatches += 1
+        print(f"{label}: {n_mismatches} routes with different lengths")
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import os
+import time
+import argparse
+import tempfile
+import yaml
+
+from northbound.vsnet.network import Network
+from northbound.vsnet.topology import Topology, load_topology
+
+def benchmark(label, func, n_repeats):
+    """
+    Returns the mean time taken by func over n_repeats calls
+    """
+    t_start = time.perf_counter()
+    for _ in range(n_repeats):
+        func()
+    elapsed = (time.perf_counter() - t_start)/n_repeats
+    print(f"{label:<32} {1000*elapsed:>10.2f} ms")
+    return elapsed
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Benchmark VSNet topology loading")
+    cli.add_argument(
+        "-c", "--config", type=str, default="config.yaml", 
+        help="path to config yaml (default: ./config.yaml)"
+    )
+    cli.add_argument(
+        "-n", "--n_repeats", type=int, default=10, 
+        help="number of times to load the topology (default: 10)"
+    )
+    args = cli.parse_args()
+
+    with open(args.config, "r") as config_yaml:
+        vsnet_config = yaml.safe_load(config_yaml)["vsnet"]
+    network_json = vsnet_config["network_json"]
+    coordinates_json = vsnet_config["coordinates_json"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot = os.path.join(tmp_dir, "topology.npz")
+        load_topology(network_json, coordinates_json, snapshot=snapshot)
+        benchmark("compile from JSON", lambda: Topology.compile(network_json, coordinates_json), args.n_repeats)
+        benchmark("load snapshot (hash checked)", lambda: load_topology(network_json, coordinates_json, snapshot=snapshot), args.n_repeats)
+        benchmark("Network from JSON", lambda: Network(network_json, coordinates_json), args.n_repeats)
+        benchmark("Network from snapshot", lambda: Network(network_json, coordinates_json, topology_snapshot=snapshot), args.n_repeats)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import time
+import uuid
+import argparse
+import tracemalloc
+
+from southbound.burro import Rule, TransferStore
+
+class LegacyTransfer:
+    """
+    One object per transfer (pre-columnar southbound.burro.Transfer)
+    """
+    def __init__(self, rule_id, src_rse, dst_rse, priority, size_GB):
+        self.id = uuid.uuid4().hex
+        self.rule_id = rule_id
+        self.src_rse = src_rse
+        self.dst_rse = dst_rse
+        self.rse_pair_id = f"{src_rse}&{dst_rse}"
+        self.priority = priority
+        self.byte_count = size_GB*10**9
+        self.state = "PREPARING"
+
+def legacy_rule(rule_config):
+    rule_id = uuid.uuid4().hex
+    return [
+        LegacyTransfer(
+            rule_id,
+            rule_config["src_rse"],
+            rule_config["dst_rse"],
+            rule_config["priority"],
+            rule_config["size_GB"]/rule_config["n_transfers"]
+        )
+        for _ in range(rule_config["n_transfers"])
+    ]
+
+def columnar_rule(rule_config):
+    rule = Rule(rule_config)
+    transfers = TransferStore()
+    transfers.add(rule)
+    return rule, transfers
+
+def measure(build, rule_config):
+    """
+    Returns the memory held by (in bytes) and the time taken to build a rule
+    """
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    rule = build(rule_config)
+    elapsed = time.perf_counter() - t_start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rule
+    return size, elapsed
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Benchmark the memory used by Burro's transfers")
+    cli.add_argument(
+        "-n", "--n_transfers", type=str, default="10000,100000,1000000",
+        help="comma-separated numbers of transfers per rule (default: 10000,100000,1000000)"
+    )
+    args = cli.parse_args()
+
+    print(
+        f"{'n_transfers':>11} {'legacy [MB]':>12} {'legacy [s]':>11} "
+        f"{'columnar [MB]':>14} {'columnar [s]':>13}"
+    )
+    for n_transfers in [int(n) for n in args.n_transfers.split(",")]:
+        rule_config = {
+            "delay": 0,
+            "src_rse": "T2_US_Caltech",
+            "dst_rse": "T2_US_UCSD",
+            "priority": 0,
+            "n_transfers": n_transfers,
+            "size_GB": n_transfers
+        }
+        legacy_size, legacy_time = measure(legacy_rule, rule_config)
+        columnar_size, columnar_time = measure(columnar_rule, rule_config)
+        print(
+            f"{n_transfers:>11} {legacy_size/1e6:>12.2f} {legacy_time:>11.3f} "
+            f"{columnar_size/1e6:>14.2f} {columnar_time:>13.3f}"
+        )
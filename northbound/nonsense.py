@@ -1,41 +1,311 @@
 import os
+import copy
 import json
+import time
 import yaml
 import uuid
-import requests
+import httpx
+import asyncio
+import sqlite3
+import logging
+from threading import Lock
+from collections import OrderedDict
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 
-api = FastAPI()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth")
-
-services = {}
+from utils.metrics import REGISTRY, instrument_api
 
 with open("config.yaml", "r") as config_yaml:
     config = yaml.safe_load(config_yaml)
     nonsense_config = config["nonsense"]
 
+api = FastAPI()
+instrument_api(api, "nonsense", profile=nonsense_config.get("profile_endpoint", False))
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth")
+
 vsnet_url = f"{os.environ['VSNET_HOST']}:{os.environ['VSNET_PORT']}"
 profile_uuid = nonsense_config["profile_uuid"]
 
 class Service:
-    def __init__(self):
-        self.id = str(uuid.uuid4())
-        self.alias = ""
-        self.route_id = ""
-        self.intent = {}
-        self.status = ""
+    __slots__ = ["id", "alias", "route_id", "intent", "status"]
+
+    def __init__(self, service_id=None, alias="", route_id="", intent=None, status=""):
+        self.id = service_id or str(uuid.uuid4())
+        self.alias = alias
+        self.route_id = route_id
+        self.intent = intent or {}
+        self.status = status
+
+    def to_json(self):
+        return json.dumps({attr: getattr(self, attr) for attr in self.__slots__})
+
+    @classmethod
+    def from_json(cls, service_json):
+        service = json.loads(service_json)
+        return cls(
+            service["id"], service["alias"], service["route_id"], service["intent"], 
+            service["status"]
+        )
+
+class InstanceStore:
+    """
+    Service instances, most recently used last; at most max_size are kept in memory,
+    and the least recently used beyond that are moved to an SQLite database at 
+    spill_path if one is given. Without one, only cancelled instances are forgotten to
+    stay within max_size (oldest first), and live instances are kept even beyond it.
+    Cancelled instances only keep their status, and are forgotten ttl seconds after 
+    they were cancelled.
+    """
+    TERMINAL_STATUSES = ["CANCEL - READY"]
+
+    def __init__(self, max_size=10000, ttl=3600., spill_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__services = OrderedDict()
+        # terminal[service ID] = time at which the service reached a terminal status
+        self.__terminal = OrderedDict()
+        self.__is_over_size = False
+        self.__lock = Lock()
+        if spill_path:
+            self.__spill = sqlite3.connect(
+                spill_path, check_same_thread=False, isolation_level=None
+            )
+            self.__spill.execute(
+                "CREATE TABLE IF NOT EXISTS services (id TEXT PRIMARY KEY, service TEXT)"
+            )
+            self.__spill.execute("DELETE FROM services")
+        else:
+            self.__spill = None
+
+    def __len__(self):
+        return len(self.__services)
+
+    def put(self, service):
+        """
+        Add or update a service instance
+        """
+        with self.__lock:
+            self.__services[service.id] = service
+            self.__services.move_to_end(service.id)
+            if service.status in self.TERMINAL_STATUSES and service.id not in self.__terminal:
+                # Nothing is provisioned from a finished instance, so only keep its status
+                service.intent = {}
+                service.route_id = ""
+                self.__terminal[service.id] = time.monotonic()
+            self.__sweep()
+
+    def get(self, service_id):
+        with self.__lock:
+            if service_id in self.__services:
+                self.__services.move_to_end(service_id)
+                return self.__services[service_id]
+            elif self.__spill:
+                row = self.__spill.execute(
+                    "SELECT service FROM services WHERE id = ?", (service_id,)
+                ).fetchone()
+                if row:
+                    self.__spill.execute("DELETE FROM services WHERE id = ?", (service_id,))
+                    service = Service.from_json(row[0])
+                    self.__services[service_id] = service
+                    self.__sweep()
+                    return service
+            raise KeyError(service_id)
+
+    def remove(self, service_id):
+        with self.__lock:
+            self.__services.pop(service_id, None)
+            self.__terminal.pop(service_id, None)
+            if self.__spill:
+                self.__spill.execute("DELETE FROM services WHERE id = ?", (service_id,))
+
+    def __sweep(self):
+        # Forget instances that have been in a terminal status for longer than the TTL
+        expiry = time.monotonic() - self.ttl
+        while self.__terminal:
+            service_id, t = next(iter(self.__terminal.items()))
+            if t > expiry:
+                break
+            del self.__terminal[service_id]
+            self.__services.pop(service_id, None)
+            if self.__spill:
+                self.__spill.execute("DELETE FROM services WHERE id = ?", (service_id,))
+        if self.__spill:
+            # Move the least recently used instances beyond the size limit
+            spilled = []
+            while len(self.__services) > self.max_size:
+                _, service = self.__services.popitem(last=False)
+                spilled.append((service.id, service.to_json()))
+            if spilled:
+                self.__spill.executemany("INSERT OR REPLACE INTO services VALUES (?, ?)", spilled)
+            return
+        # Nowhere to move instances to, so only forget those that can no longer be used
+        while len(self.__services) > self.max_size and self.__terminal:
+            service_id, _ = self.__terminal.popitem(last=False)
+            self.__services.pop(service_id, None)
+        is_over_size = len(self.__services) > self.max_size
+        if is_over_size and not self.__is_over_size:
+            logging.warning(
+                f"{len(self.__services)} live service instances exceed the limit of "
+                f"{self.max_size}; set instances.spill_path to move the least recently "
+                "used ones out of memory"
+            )
+        self.__is_over_size = is_over_size
+
+class SiteRegistry:
+    """
+    Configured sites, indexed by name, root URI and full URI; full URIs are also
+    indexed by their n-grams (of up to ngram_size characters) for substring search
+    """
+    KEYS = ["name", "root_uri", "full_uri"]
+
+    def __init__(self, sites, ngram_size=3):
+        self.sites = list(sites)
+        self.ngram_size = ngram_size
+        # index[key][value] = position of the first site with that value
+        self.__index = {key: {} for key in self.KEYS}
+        # ngrams[n-gram] = set of positions of the sites whose full URI contains it
+        self.__ngrams = {}
+        for site_i, site_info in enumerate(self.sites):
+            for key in self.KEYS:
+                self.__index[key].setdefault(site_info[key], site_i)
+            full_uri = site_info["full_uri"]
+            for n in range(1, ngram_size + 1):
+                for char_i in range(len(full_uri) - n + 1):
+                    self.__ngrams.setdefault(full_uri[char_i:char_i + n], set()).add(site_i)
+
+    def find(self, root_uri="", full_uri="", name=""):
+        """
+        Returns the first configured site with the given name, root URI or full URI
+        """
+        positions = [
+            self.__index[key].get(value) for key, value in 
+            [("name", name), ("root_uri", root_uri), ("full_uri", full_uri)] if value
+        ]
+        positions = [site_i for site_i in positions if site_i is not None]
+        if positions:
+            return self.sites[min(positions)]
+
+    def search(self, pattern):
+        """
+        Returns every configured site whose full URI contains pattern, in order
+        """
+        if not pattern:
+            return list(self.sites)
+        elif len(pattern) <= self.ngram_size:
+            candidates = self.__ngrams.get(pattern, set())
+        else:
+            # Every n-gram of the pattern must be in the full URI; check the rest
+            n = self.ngram_size
+            postings = sorted(
+                (self.__ngrams.get(pattern[char_i:char_i + n], set()) 
+                 for char_i in range(len(pattern) - n + 1)),
+                key=len
+            )
+            candidates = set.intersection(*postings)
+            candidates = {
+                site_i for site_i in candidates if pattern in self.sites[site_i]["full_uri"]
+            }
+        return [self.sites[site_i] for site_i in sorted(candidates)]
+
+class ProfileCache:
+    """
+    Service profiles, parsed once and reloaded only when the file changes on disk; 
+    callers get their own (deep) copy of the parsed profile
+    """
+    def __init__(self, profile_dir="data/profiles"):
+        self.profile_dir = profile_dir
+        # profiles[profile UUID] = ((mtime, size), raw JSON, parsed JSON)
+        self.__profiles = {}
+        self.__lock = Lock()
+
+    def __load(self, profile_uuid):
+        path = f"{self.profile_dir}/{profile_uuid}.json"
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.__profiles.get(profile_uuid)
+        if cached and cached[0] == version:
+            return cached
+        with self.__lock:
+            with open(path, "r") as profile_json:
+                raw = profile_json.read()
+            cached = (version, raw, json.loads(raw))
+            self.__profiles[profile_uuid] = cached
+            return cached
+
+    def raw(self, profile_uuid):
+        return self.__load(profile_uuid)[1]
+
+    def get(self, profile_uuid):
+        return copy.deepcopy(self.__load(profile_uuid)[2])
+
+class RouteCache:
+    """
+    VSNet route answers (route ID and capacity), kept for ttl seconds; concurrent 
+    queries for the same (src, dst) pair share a single request to VSNet
+    """
+    def __init__(self, ttl=0.5):
+        self.ttl = ttl
+        # routes[(src, dst)] = (expiry time, task that fetches the route)
+        self.__routes = {}
+
+    async def get(self, client, src, dst):
+        t = time.monotonic()
+        cached = self.__routes.get((src, dst))
+        if cached and cached[0] > t:
+            return await asyncio.shield(cached[1])
+
+        # Forget expired answers before adding a new one
+        for key in [key for key, (expiry, _) in self.__routes.items() if expiry <= t]:
+            del self.__routes[key]
+        task = asyncio.create_task(self.__fetch(client, src, dst))
+        if self.ttl > 0:
+            self.__routes[(src, dst)] = (t + self.ttl, task)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # Do not cache failures
+            if self.__routes.get((src, dst), (None, None))[1] is task:
+                del self.__routes[(src, dst)]
+            raise
+
+    @staticmethod
+    async def __fetch(client, src, dst):
+        params = {key: value for key, value in [("src", src), ("dst", dst)] if value is not None}
+        response = await client.get(f"http://{vsnet_url}/routes", params=params)
+        response.raise_for_status()
+        return response.json()
+
+VSNET_REQUESTS = REGISTRY.counter(
+    "http_client_requests_total", "HTTP requests sent", labelnames=("target", "method", "status")
+)
+
+async def count_vsnet_request(response):
+    VSNET_REQUESTS.inc(target="vsnet", method=response.request.method, status=response.status_code)
+
+sites = SiteRegistry(nonsense_config.get("sites", []))
+instances = InstanceStore(**nonsense_config.get("instances", {}))
+profiles = ProfileCache()
+routes = RouteCache(ttl=nonsense_config.get("route_cache_ttl", 0.5))
+
+@api.on_event("startup")
+async def open_vsnet_client():
+    # Shared by every request, so connections to VSNet are kept alive
+    api.state.vsnet = httpx.AsyncClient(
+        timeout=nonsense_config.get("vsnet_timeout", 10.),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+        event_hooks={"response": [count_vsnet_request]}
+    )
+
+@api.on_event("shutdown")
+async def close_vsnet_client():
+    await api.state.vsnet.aclose()
 
 def site_info_lookup(key, root_uri="", full_uri="", name=""):
-    for site_info in nonsense_config.get("sites", []):
-        if name and name == site_info["name"]:
-            return site_info.get(key, None)
-        elif root_uri and root_uri == site_info["root_uri"]:
-            return site_info.get(key, None)
-        elif full_uri and full_uri == site_info["full_uri"]:
-            return site_info.get(key, None)
+    site_info = sites.find(root_uri=root_uri, full_uri=full_uri, name=name)
+    if site_info:
+        return site_info.get(key, None)
 
 @api.post("/auth")
 async def authenticate(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -43,21 +313,31 @@ async def authenticate(form_data: OAuth2PasswordRequestForm = Depends()):
 
 @api.get("/api/profile/{profile_uuid}")
 def profile(profile_uuid: str):
-    with open(f"data/profiles/{profile_uuid}.json", "r") as profile_json:
-        return profile_json.read()
+    return profiles.raw(profile_uuid)
+
+def find_service(instance_uuid):
+    try:
+        return instances.get(instance_uuid)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f"instance with UUID {instance_uuid} not found"
+        )
 
 @api.delete("/api/service/{instance_uuid}")
 def delete_service(instance_uuid: str):
-    return
+    instances.remove(instance_uuid)
 
 @api.get("/api/instance", response_class=PlainTextResponse)
 def create_instance():
     service = Service()
-    services[service.id] = service
+    instances.put(service)
     return service.id
 
 @api.post("/api/instance/{instance_uuid}")
-def query_instance(instance_uuid: str, new_intent: dict):
+async def query_instance(instance_uuid: str, new_intent: dict):
+    service = find_service(instance_uuid)
+
     # Initialize response
     response = {
         "service_uuid": instance_uuid,
@@ -66,9 +346,7 @@ def query_instance(instance_uuid: str, new_intent: dict):
     }
 
     # Load service profile
-    with open(f"data/profiles/{profile_uuid}.json", "r") as profile_json:
-        profile = json.load(profile_json)
-        intent = profile["intent"]["data"]
+    intent = profiles.get(profile_uuid)["intent"]["data"]
 
     # Parse queries and edit instance data
     for query in new_intent.get("queries", []):
@@ -94,35 +372,55 @@ def query_instance(instance_uuid: str, new_intent: dict):
                 for option in query["options"]:
                     if "name" in option:
                         connection_names.append(option["name"])
-            for connection_i, connection_data in enumerate(intent["connections"]):
-                if connection_names and connection_data["name"] not in connection_names:
-                    continue
-                src_data, dst_data = connection_data["terminals"]
-                route_info = requests.get(
-                    f"http://{vsnet_url}/routes", 
-                    params={
-                        "src": site_info_lookup("name", root_uri=src_data["uri"]),
-                        "dst": site_info_lookup("name", root_uri=dst_data["uri"])
-                    }
-                ).json()
+            connections = [
+                connection_data for connection_data in intent["connections"]
+                if not connection_names or connection_data["name"] in connection_names
+            ]
+            # Query the routes of every connection concurrently
+            try:
+                route_infos = await asyncio.gather(*[
+                    routes.get(
+                        api.state.vsnet,
+                        site_info_lookup("name", root_uri=connection_data["terminals"][0]["uri"]),
+                        site_info_lookup("name", root_uri=connection_data["terminals"][1]["uri"])
+                    )
+                    for connection_data in connections
+                ])
+            except httpx.HTTPStatusError as error:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"VSNet route query failed ({error.response.status_code}): {error.response.text}"
+                )
+            except httpx.HTTPError as error:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"VSNet route query failed: {error!r}"
+                )
+            for connection_data, route_info in zip(connections, route_infos):
                 answer["results"].append(
                     {"bandwidth": str(route_info["capacity"]), "name": connection_data["name"]}
                 )
-                services[instance_uuid].route_id = route_info["route_id"]
+                service.route_id = route_info["route_id"]
 
         response["queries"].append(answer)
 
     # Update service instance
-    services[instance_uuid].intent.update(intent)
-    services[instance_uuid].alias = new_intent.get("alias", "")
+    service.intent.update(intent)
+    service.alias = new_intent.get("alias", "")
+    instances.put(service)
 
     return response
 
 @api.put("/api/instance/{instance_uuid}/{action}")
-def affect_instance(instance_uuid: str, action: str):
+async def affect_instance(instance_uuid: str, action: str):
     if action == "provision" or action == "reprovision":
         # Retrieve service instance
-        service = services[instance_uuid]
+        service = find_service(instance_uuid)
+        if not service.intent.get("connections"):
+            raise HTTPException(
+                status_code=409,
+                detail=f"instance with UUID {instance_uuid} has nothing to provision (status: {service.status})"
+            )
         connection_data = service.intent["connections"][0]
         src_root_uri = connection_data["terminals"][0]["uri"]
         dst_root_uri = connection_data["terminals"][1]["uri"]
@@ -140,34 +438,36 @@ def affect_instance(instance_uuid: str, action: str):
                 detail=f"resource with root URI {dst_root_uri} not found"
             )
         # Send data to VSNet
-        requests.put(
+        await api.state.vsnet.put(
             f"http://{vsnet_url}/connections/{service.alias}/update", 
             params={
                 "bandwidth": float(connection_data["bandwidth"]["capacity"]),
                 "route_id": service.route_id
             }
         )
-        services[instance_uuid].status = "CREATE - READY"
+        service.status = "CREATE - READY"
+        instances.put(service)
     elif action == "cancel":
-        services[instance_uuid].status = "CANCEL - READY"
+        service = find_service(instance_uuid)
+        service.status = "CANCEL - READY"
+        instances.put(service)
 
 @api.get("/api/instance/{instance_uuid}/status", response_class=PlainTextResponse)
 def check_instance(instance_uuid: str):
-    return services[instance_uuid].status
+    return find_service(instance_uuid).status
 
 @api.delete("/api/instance/{instance_uuid}")
 def delete_instance(instance_uuid: str):
-    return
+    instances.remove(instance_uuid)
 
 @api.get("/api/discover/lookup/{pattern}")
 def lookup_name(pattern: str, search: str = ""):
     results = []
-    for site_info in nonsense_config.get("sites", []):
-        if pattern in site_info["full_uri"]:
-            results.append({
-                "resource": site_info["full_uri"],
-                "name/tag/value": site_info["name"]
-            })
+    for site_info in sites.search(pattern):
+        results.append({
+            "resource": site_info["full_uri"],
+            "name/tag/value": site_info["name"]
+        })
     return {"results": results}
 
 @api.get("/api/discover/lookup/{full_uri}/rooturi", response_class=PlainTextResponse)
@@ -1,39 +1,167 @@
+import io
+import json
 import yaml
+import asyncio
+import logging
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from typing import List, Optional
 from pydantic import BaseModel
 
-from northbound.vsnet.connection import Connection
-from northbound.vsnet.network import Network
+from utils.vtime import now, get_time_dilation
+from utils.metrics import instrument_api
+from northbound.vsnet.service import VSNet
 
 with open("config.yaml", "r") as config_yaml:
     config = yaml.safe_load(config_yaml)
     vsnet_config = config["vsnet"]
 
-vsnet = Network(
-    vsnet_config["network_json"],
-    vsnet_config["coordinates_json"],
-    max_beff_passes=vsnet_config.get("max_beff_passes", 100),
-    beff_frac=vsnet_config.get("beff_frac", 0.25)
-)
+vsnet = VSNet(vsnet_config)
 api = FastAPI()
+instrument_api(api, "vsnet", profile=vsnet_config.get("profile_endpoint", False))
 
-connections = {}
+class SitePair(BaseModel):
+    src: str
+    dst: str
 
-def find_connection(connection_id):
-    if connection_id not in connections:
+class NewConnection(BaseModel):
+    burro_id: str
+    src: str
+    dst: str
+    total_data: float
+
+class ConnectionUpdate(BaseModel):
+    connection_id: str
+    bandwidth: float
+    route_id: str
+
+@api.on_event("startup")
+def warm_route_cache():
+    vsnet.warm_route_cache()
+
+async def finalize_connections(max_wait):
+    """
+    Finish connections as the clock passes their projected end times, rather than 
+    whenever they are next checked; wakes up at least every max_wait seconds to pick 
+    up end times that moved in the meantime
+    """
+    def finalize():
+        vsnet.finalize()
+        return vsnet.next_end_time()
+
+    while True:
+        try:
+            # Both take the VSNet lock, so keep the event loop free while waiting for it
+            next_end_time = await asyncio.to_thread(finalize)
+        except Exception:
+            # Keep finalizing connections after an unexpected error
+            logging.exception("Failed to finalize connections")
+            next_end_time = None
+        if next_end_time is None:
+            wait = max_wait
+        else:
+            wait = min(max((next_end_time - now())/get_time_dilation(), 0.), max_wait)
+        await asyncio.sleep(wait)
+
+@api.on_event("startup")
+async def start_finalizer():
+    api.state.finalizer = asyncio.create_task(
+        finalize_connections(vsnet_config.get("finalize_interval", 1.))
+    )
+
+def require_connection(connection_id):
+    """
+    Raise a 404 unless VSNet knows the connection, either as an active one or as a 
+    finished one that only its summary is left of
+    """
+    if vsnet.is_finished(connection_id):
+        return
+    try:
+        vsnet.find_connection(connection_id)
+    except KeyError:
         raise HTTPException(
             status_code=404,
             detail=f"connection with {connection_id} not found"
         )
-    else:
-        return connections[connection_id]
-
-async def construct_history():
-    return [connection.__dict__ for connection in connections.values()]
 
 @api.get("/history")
-async def get_history():
-    return await construct_history()
+def get_history(cursor: int = 0, since: Optional[float] = None, limit: Optional[int] = None):
+    """
+    Stream the latest summary of every VSNet Connection that changed after the given 
+    cursor as newline-delimited JSON, oldest change first; the cursor for the next 
+    request is returned in the X-Next-Cursor header. Served from snapshots without 
+    waiting for the VSNet lock.
+
+    - **cursor**: X-Next-Cursor of the previous request (0 for everything)
+    - **since**: only return connections that changed at or after this (virtual) time
+    - **limit**: maximum number of connections to return
+    """
+    records, next_cursor = vsnet.history(cursor=cursor, since=since, limit=limit)
+    return StreamingResponse(
+        (json.dumps(record) + "\n" for record in records),
+        media_type="application/x-ndjson",
+        headers={"X-Next-Cursor": str(next_cursor)}
+    )
+
+@api.get("/events")
+def get_events(after: int = 0, timeout: float = 30.):
+    """
+    Long-poll for connection events: returns as soon as there are events numbered after 
+    the given one (or once the timeout has passed); each event is either {seq, type: 
+    "finished", connection_id, time} or {seq, type: "bandwidth", connection_id, 
+    bandwidth, projected_end_time}, and "missed" is set if events after the given one 
+    were already dropped
+
+    - **after**: sequence number of the last event seen (0 for all buffered events)
+    - **timeout**: maximum number of seconds to wait for an event
+    """
+    return vsnet.events(after=after, timeout=min(timeout, 60.))
+
+def check_utilization():
+    if vsnet.network.utilization is None:
+        raise HTTPException(status_code=404, detail="link utilization is not being recorded")
+
+@api.get("/links/utilization")
+def get_link_utilization(link: str, start: Optional[float] = None, end: Optional[float] = None):
+    """
+    Get the prioritized and best-effort bandwidth in use on a link over time, from 
+    the finest-resolution samples that cover the start time; every sample holds the 
+    peak and the last value within its time bucket
+
+    - **link**: name of the link
+    - **start**: earliest (virtual) time to return samples for
+    - **end**: latest (virtual) time to return samples for
+    """
+    check_utilization()
+    try:
+        return vsnet.get_link_utilization(link, start=start, end=end)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"link {link} not found")
+
+@api.get("/links/congested")
+def get_congested_links(n_links: int = 10, start: Optional[float] = None):
+    """
+    Get the links with the highest peak utilization (as a fraction of capacity)
+
+    - **n_links**: number of links to return
+    - **start**: only consider utilization at or after this (virtual) time
+    """
+    check_utilization()
+    return vsnet.get_congested_links(n_links=n_links, start=start)
+
+@api.get("/links/utilization/export")
+def export_utilization():
+    """
+    Download every recorded utilization sample as a compressed NumPy archive (.npz)
+    """
+    check_utilization()
+    npz = io.BytesIO()
+    vsnet.export_utilization(npz)
+    return Response(
+        content=npz.getvalue(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=utilization.npz"}
+    )
 
 @api.get("/routes")
 def get_route(src: str, dst: str):
@@ -43,11 +171,67 @@ def get_route(src: str, dst: str):
     - **src**: name of source site (RSE name)
     - **dst**: name of destination site (RSE name)
     """
-    route = vsnet.dijkstra(vsnet_config["sites"][src], vsnet_config["sites"][dst])
-    return {
-        "route_id": route.id,
-        "capacity": route.get_capacity()
-    }
+    return vsnet.get_route(src, dst)
+
+@api.post("/routes/batch")
+def get_routes(site_pairs: List[SitePair]):
+    """
+    Get best route between each of the given sources and destinations; returns one 
+    result per pair, in order
+
+    - **site_pairs**: list of {src, dst} site (RSE) names
+    """
+    return vsnet.get_routes([dict(site_pair) for site_pair in site_pairs])
+
+@api.get("/routes/ranked")
+def get_ranked_routes(src: str, dst: str, n_routes: int = 5):
+    """
+    Get the N shortest loopless routes between a given source and destination, 
+    ordered by cost
+
+    - **src**: name of source site (RSE name)
+    - **dst**: name of destination site (RSE name)
+    - **n_routes**: maximum number of routes to return
+    """
+    return vsnet.get_ranked_routes(src, dst, n_routes=n_routes)
+
+@api.post("/connections/batch/check")
+def check_connections(connection_ids: List[str]):
+    """
+    Check status of many VSNet Connections; returns one result per connection, in order
+
+    - **connection_ids**: list of connection identifiers (RuleID_Src_Dst)
+    """
+    return vsnet.check_connections(connection_ids)
+
+@api.post("/connections/batch")
+def create_connections(new_connections: List[NewConnection]):
+    """
+    Create many VSNet Connections; returns one result per connection, in order
+
+    - **new_connections**: list of {burro_id, src, dst, total_data} (see POST /connections)
+    """
+    return vsnet.create_connections([dict(new_connection) for new_connection in new_connections])
+
+@api.put("/connections/batch/update")
+def update_connections(updates: List[ConnectionUpdate]):
+    """
+    Update many VSNet Connections with new bandwidths; returns one result per 
+    connection, in order
+
+    - **updates**: list of {connection_id, bandwidth, route_id} (see PUT /connections/{connection_id}/update)
+    """
+    return vsnet.update_connections([dict(update) for update in updates])
+
+@api.put("/connections/batch/start")
+def start_connections(connection_ids: List[str]):
+    """
+    Start VSNet "transfers" across many Connections; returns one result per 
+    connection, in order
+
+    - **connection_ids**: list of connection identifiers
+    """
+    return vsnet.start_connections(connection_ids)
 
 @api.get("/connections/{connection_id}/check")
 def check_connection(connection_id: str):
@@ -56,12 +240,8 @@ def check_connection(connection_id: str):
 
     - **connection_id**: identifier for connection (RuleID_Src_Dst)
     """
-    connection = find_connection(connection_id)
-    connection.check()
-    return {
-        "is_finished": connection.is_finished,
-        "remaining_time": connection.compute_remaining_time()
-    }
+    require_connection(connection_id)
+    return vsnet.check_connection(connection_id)
 
 @api.post("/connections")
 def create_connection(burro_id: str, src: str, dst: str, total_data: float):
@@ -73,8 +253,7 @@ def create_connection(burro_id: str, src: str, dst: str, total_data: float):
     - **dst**: name of destination site (RSE name)
     - **total_data**: total amount of data to be transfered from src to dst in bytes
     """
-    connection_id = f"{burro_id}_{src}_{dst}"
-    connections[connection_id] = Connection(connection_id, total_data)
+    vsnet.create_connection(burro_id, src, dst, total_data)
 
 @api.put("/connections/{connection_id}/update")
 def update_connection(connection_id: str, bandwidth: float, route_id: str):
@@ -84,9 +263,8 @@ def update_connection(connection_id: str, bandwidth: float, route_id: str):
     - **connection_id**: identifier for connection
     - **bandwidth**: bandwidth provision in bytes/sec
     """
-    connection = find_connection(connection_id)
-    promise = vsnet.get_promise(route_id, bandwidth)
-    connection.update(promise)
+    require_connection(connection_id)
+    vsnet.update_connection(connection_id, bandwidth, route_id)
 
 @api.put("/connections/{connection_id}/start")
 def start_connection(connection_id: str):
@@ -95,6 +273,5 @@ def start_connection(connection_id: str):
 
     - **connection_id**: identifier for connection
     """
-    connection = find_connection(connection_id)
-    if not connection.is_active:
-        connection.start()
+    require_connection(connection_id)
+    vsnet.start_connection(connection_id)
@@ -1,8 +1,14 @@
 from utils.vtime import now
-from northbound.vsnet.network import Promise, BestEffort
+from northbound.vsnet.network import Promise, BestEffort, INFINITY
 
 class Connection:
-    def __init__(self, connection_id, total_data):
+    """
+    Transfer of total_data bytes over a sequence of promises; the bytes delivered are
+    kept up to date whenever the bandwidth changes, so the projected end time is known
+    in closed form and only has to be recomputed at those changes (on_change is called
+    with the connection after each one)
+    """
+    def __init__(self, connection_id, total_data, on_change=None, clock=None):
         self.total_data = total_data
         self.id = connection_id
         self.promises = []
@@ -10,51 +16,118 @@ class Connection:
         self.is_finished = False
         self.start_time = None
         self.end_time = None
+        self.projected_end_time = None
+        self.on_change = on_change
+        self.now = now if clock is None else clock.now
+        # Bytes delivered as of rate_time, and the bandwidth since then
+        self.__bytes = 0.
+        self.__rate_time = None
+        self.__bandwidth = 0.
 
     @property
     def duration(self):
-        if not self.start_time:
+        if self.start_time is None:
             return 0
-        elif not self.end_time:
-            return now() - self.start_time
+        elif self.end_time is None:
+            return self.now() - self.start_time
         else:
             return self.end_time - self.start_time
 
+    @property
+    def bandwidth(self):
+        return self.__bandwidth
+
+    def delivered(self, t=None):
+        """
+        Returns the number of bytes delivered as of time t (default: now)
+        """
+        if self.__rate_time is None:
+            return 0.
+        t = self.now() if t is None else t
+        return self.__bytes + (t - self.__rate_time)*self.__bandwidth
+
+    def summary(self):
+        """
+        Returns a fixed-size record of the state of this connection
+        """
+        return {
+            "id": self.id,
+            "total_data": self.total_data,
+            "is_active": self.is_active,
+            "is_finished": self.is_finished,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "bandwidth": self.__bandwidth,
+            "bytes_delivered": self.__bytes,
+            "updated_at": self.__rate_time,
+            "projected_end_time": self.projected_end_time,
+            "n_promises": len(self.promises)
+        }
+
+    def __set_bandwidth(self, bandwidth, t):
+        self.__bytes = self.delivered(t)
+        self.__rate_time = t
+        self.__bandwidth = bandwidth
+        if self.is_active and bandwidth > 0:
+            self.projected_end_time = t + (self.total_data - self.__bytes)/bandwidth
+        else:
+            self.projected_end_time = None
+        if self.on_change:
+            self.on_change(self)
+
+    def __on_promise_update(self, promise, t):
+        self.__set_bandwidth(promise.bandwidth, t)
+
     def compute_remaining_time(self):
         if self.is_active:
-            remaining_data = self.total_data
-            for promise in self.promises[:-1]:
-                remaining_data -= promise.bytes
-            
-            return remaining_data/self.promises[-1].bandwidth
+            if self.projected_end_time is None:
+                return INFINITY
+            else:
+                return max(self.projected_end_time - self.now(), 0.)
         else:
             return None
-    
+
     def compute_end_time(self):
         if self.is_active:
-            return self.promises[-1].start_time + self.compute_remaining_time()
+            return INFINITY if self.projected_end_time is None else self.projected_end_time
         else:
             return None
 
-    def check(self):
-        if self.is_active:
-            end_time = self.compute_end_time()
-            if end_time <= now():
-                self.promises[-1].end(t=end_time)
-                self.end_time = end_time
-                self.is_active = False
-                self.is_finished = True
+    def check(self, t=None):
+        """
+        Finish the connection if its projected end time is at or before time t
+        (default: now)
+        """
+        t = self.now() if t is None else t
+        if self.is_active and self.projected_end_time is not None and self.projected_end_time <= t:
+            self.finish(self.projected_end_time)
+
+    def finish(self, t):
+        last_promise = self.promises[-1]
+        last_promise.on_update = None
+        last_promise.end(t=t)
+        self.end_time = t
+        self.is_active = False
+        self.is_finished = True
+        self.__set_bandwidth(0., t)
 
     def update(self, promise):
         self.check()
         if self.is_active and len(self.promises) > 0:
-            start_time = now()
+            start_time = self.now()
+            self.promises[-1].on_update = None
             self.promises[-1].end(t=start_time)
+            promise.on_update = self.__on_promise_update
             promise.start(t=start_time)
+            self.__set_bandwidth(promise.bandwidth, start_time)
 
         self.promises.append(promise)
 
     def start(self):
-        self.promises[-1].start()
-        self.start_time = self.promises[-1].start_time
+        start_time = self.now()
+        self.start_time = start_time
         self.is_active = True
+        promise = self.promises[-1]
+        promise.on_update = self.__on_promise_update
+        promise.start(t=start_time)
+        self.__set_bandwidth(promise.bandwidth, start_time)
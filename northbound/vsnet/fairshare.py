@@ -0,0 +1,63 @@
+import numpy as np
+
+def connected_flows(seed_links, link_flows, flow_links):
+    """
+    Returns the links and flows that are connected to the given links, where two 
+    flows are connected if they (transitively) share at least one link
+
+    - seed_links: iterable of link keys to start from
+    - link_flows: dict of link key -> flows that use that link
+    - flow_links: function mapping a flow to the keys of the links that it uses
+    """
+    links = set()
+    flows = {}
+    stack = list(seed_links)
+    while len(stack) > 0:
+        link = stack.pop()
+        if link in links:
+            continue
+        links.add(link)
+        for flow in link_flows.get(link, ()):
+            if flow not in flows:
+                flows[flow] = None
+                stack.extend(flow_links(flow))
+
+    return links, list(flows)
+
+def max_min_fair(flow_ids, link_ids, capacities, n_flows):
+    """
+    Exact max-min fair (progressive filling) allocation of link capacity to flows, 
+    vectorized over a sparse (COO) link x flow incidence matrix: each iteration finds 
+    the current bottleneck level with a single min-reduction over the fair shares of 
+    all links and freezes every flow that crosses a link at that level, so the number 
+    of iterations is the number of distinct bottleneck levels. Returns an array of 
+    rates indexed by flow.
+
+    - flow_ids, link_ids: incidence entries (flow_ids[i] uses link link_ids[i]), 
+      where flows are numbered 0..n_flows-1 and links 0..len(capacities)-1
+    - capacities: array of link capacities
+    - n_flows: number of flows
+    """
+    rates = np.zeros(n_flows)
+    is_frozen = np.zeros(n_flows, dtype=bool)
+    remaining = np.array(capacities, dtype=float)
+    n_links = len(remaining)
+    is_active = np.ones(len(flow_ids), dtype=bool)
+    while np.any(is_active):
+        # Fair share of every link among its unfrozen flows
+        n_unfrozen = np.bincount(link_ids[is_active], minlength=n_links)
+        is_used = n_unfrozen > 0
+        shares = np.full(n_links, np.inf)
+        shares[is_used] = np.maximum(remaining[is_used], 0.)/n_unfrozen[is_used]
+        # Freeze every unfrozen flow that crosses a bottleneck link
+        level = shares.min()
+        is_bottleneck = shares <= level*(1 + 1e-12)
+        new_flow_ids = flow_ids[is_active & is_bottleneck[link_ids]]
+        rates[new_flow_ids] = level
+        is_frozen[new_flow_ids] = True
+        # Remove the newly frozen flows' shares from every link that they cross
+        is_new = is_active & is_frozen[flow_ids]
+        remaining -= level*np.bincount(link_ids[is_new], minlength=n_links)
+        is_active &= ~is_new
+
+    return rates
@@ -0,0 +1,78 @@
+import numpy as np
+
+class LinkState:
+    """
+    Array-backed bandwidth bookkeeping for every link in a network; each link is
+    assigned a stable integer ID that indexes contiguous float64 arrays, such that
+    per-route operations become vectorized reductions over those IDs
+    """
+    def __init__(self, capacity=64):
+        self.n_links = 0
+        self.total_bandwidth = np.zeros(capacity)
+        self.beff_frac = np.zeros(capacity)
+        self.prio_bandwidth = np.zeros(capacity)
+        self.beff_bandwidth = np.zeros(capacity)
+        self.n_besteffs = np.zeros(capacity, dtype=np.int64)
+
+    def __grow(self):
+        capacity = 2*len(self.total_bandwidth)
+        for attr in ["total_bandwidth", "beff_frac", "prio_bandwidth", "beff_bandwidth", "n_besteffs"]:
+            old_array = getattr(self, attr)
+            new_array = np.zeros(capacity, dtype=old_array.dtype)
+            new_array[:len(old_array)] = old_array
+            setattr(self, attr, new_array)
+
+    def add(self, bandwidth, beff_frac):
+        """
+        Register a new link and return its ID
+        """
+        if self.n_links == len(self.total_bandwidth):
+            self.__grow()
+
+        link_id = self.n_links
+        self.total_bandwidth[link_id] = bandwidth
+        self.beff_frac[link_id] = beff_frac
+        self.prio_bandwidth[link_id] = bandwidth*(1 - beff_frac)
+        self.beff_bandwidth[link_id] = bandwidth*beff_frac
+        self.n_links += 1
+        return link_id
+
+    @property
+    def beff_capacity(self):
+        return self.total_bandwidth[:self.n_links]*self.beff_frac[:self.n_links]
+
+    def reserve(self, link_ids, bandwidth, is_besteff=False):
+        free_bandwidth = self.beff_bandwidth if is_besteff else self.prio_bandwidth
+        orig_bandwidth = free_bandwidth[link_ids]
+        if np.any(orig_bandwidth - bandwidth < 0):
+            raise ValueError(
+                f"taking {bandwidth} exceeds free bandwidth ({orig_bandwidth.min()})"
+            )
+        else:
+            free_bandwidth[link_ids] -= bandwidth
+
+    def free(self, link_ids, bandwidth, is_besteff=False):
+        new_bandwidth = (
+            self.beff_bandwidth[link_ids] + self.prio_bandwidth[link_ids] + bandwidth
+        )
+        if np.any(new_bandwidth > self.total_bandwidth[link_ids]):
+            raise ValueError(
+                f"freeing {bandwidth} exceeds max bandwidth ({self.total_bandwidth[link_ids].min()})"
+            )
+        else:
+            free_bandwidth = self.beff_bandwidth if is_besteff else self.prio_bandwidth
+            free_bandwidth[link_ids] += bandwidth
+
+    def get_capacity(self, link_ids, is_besteff=False):
+        """
+        Returns the bottleneck capacity along the given links
+        """
+        if len(link_ids) == 0:
+            return 0
+        elif is_besteff:
+            n_besteffs = self.n_besteffs[link_ids]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shares = self.beff_bandwidth[link_ids]/n_besteffs
+            return float(np.where(n_besteffs > 0, shares, np.inf).min())
+        else:
+            return float(self.prio_bandwidth[link_ids].min())
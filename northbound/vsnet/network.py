@@ -1,23 +1,28 @@
-import json
 import base64
-from math import radians, cos, sin, asin, sqrt
+import numpy as np
+from heapq import heappush, heappop
+from threading import Lock
+from collections import OrderedDict
 
 from utils.vtime import now
+from utils.metrics import REGISTRY, timed
+from northbound.vsnet.fairshare import connected_flows, max_min_fair
+from northbound.vsnet.linkstate import LinkState
+from northbound.vsnet.utilization import UtilizationRecorder
+from northbound.vsnet.topology import load_topology, distance
 
 INFINITY = 1e12
 
-def distance(lat1, lat2, lon1, lon2):
-     # Converts degrees to radians
-     lon1 = radians(lon1)
-     lon2 = radians(lon2)
-     lat1 = radians(lat1)
-     lat2 = radians(lat2)
-     # Uses Haversine formula then multiplies by 6371 KM (radius of Earth); for miles use 3956
-     km_distance = 2*asin(sqrt(
-         sin((lat2 - lat1)/2)**2
-         + cos(lat1)*cos(lat2)*sin((lon2 - lon1)/2)**2
-     ))*6371
-     return round(km_distance, 3)
+ROUTE_COMPUTATIONS = REGISTRY.counter(
+    "vsnet_route_computations_total", "Routes computed (route cache misses)", labelnames=("algo",)
+)
+ROUTE_CACHE_HITS = REGISTRY.counter("vsnet_route_cache_hits_total", "Routes served from the cache")
+BESTEFF_PASSES = REGISTRY.counter(
+    "vsnet_besteff_passes_total", "Best-effort bandwidth redistribution passes"
+)
+BESTEFF_UPDATES = REGISTRY.counter(
+    "vsnet_besteff_updates_total", "Best efforts whose bandwidth changed in a redistribution pass"
+)
 
 class Promise:
     def __init__(self, network, route, bandwidth):
@@ -26,6 +31,8 @@ class Promise:
         self.bandwidth = bandwidth
         self.start_time = None
         self.end_time = None
+        # Called with (promise, t) whenever the bandwidth changes at time t
+        self.on_update = None
 
     @property
     def bytes(self):
@@ -33,19 +40,19 @@ class Promise:
 
     @property
     def duration(self):
-        if not self.start_time:
+        if self.start_time is None:
             return 0
-        elif not self.end_time:
-            return now() - self.start_time
+        elif self.end_time is None:
+            return self.network.now() - self.start_time
         else:
             return self.end_time - self.start_time
 
     def start(self, t=None):
-        self.start_time = t or now()
+        self.start_time = self.network.now() if t is None else t
         self.network.fulfill_promise(self)
 
     def end(self, t=None):
-        self.end_time = t or now()
+        self.end_time = self.network.now() if t is None else t
         self.network.release_promise(self)
 
 class BestEffort(Promise):
@@ -60,29 +67,39 @@ class BestEffort(Promise):
     def bytes(self):
         return self.__bytes + self.duration*self.bandwidth
 
-    def update(self, bandwidth):
-        self.__bytes += self.duration*self.bandwidth
-        self.start_time = now()
+    def update(self, bandwidth, t=None):
+        t = self.network.now() if t is None else t
+        self.__bytes += (t - self.start_time)*self.bandwidth
+        self.start_time = t
         self.bandwidth = bandwidth
+        if self.on_update:
+            self.on_update(self, t)
 
     def start(self, t=None):
-        self.start_time = t or now()
-        self.network.distrib_besteff(self)
+        self.start_time = self.network.now() if t is None else t
+        self.network.distrib_besteff(self, t=self.start_time)
 
     def end(self, t=None):
-        self.end_time = t or now()
-        self.network.release_besteff(self)
+        self.end_time = self.network.now() if t is None else t
+        self.network.release_besteff(self, t=self.end_time)
 
 class Route:
     def __init__(self, start_node=None, end_node=None, links=None):
         self.links = links or []
         self.start_node = start_node
         self.end_node = end_node
+        self.__link_ids = None
 
     @property
     def link_names(self):
         return [link.name for link in self.links]
 
+    @property
+    def link_ids(self):
+        if self.__link_ids is None or len(self.__link_ids) != len(self.links):
+            self.__link_ids = np.array([link.id for link in self.links], dtype=np.int64)
+        return self.__link_ids
+
     @property
     def id(self):
         link_names = sorted(self.link_names)
@@ -97,28 +114,72 @@ class Route:
     def __eq__(self, other_route):
         return self.id == other_route.id
 
+    @property
+    def cost(self):
+        return sum([link.length for link in self.links])
+
     def get_capacity(self, is_besteff=False):
         if len(self.links) > 0:
-            if is_besteff:
-                return min([link.beff_bandwidth/link.n_besteffs for link in self.links])
-            else:
-                return min([link.prio_bandwidth for link in self.links])
+            return self.links[0].state.get_capacity(self.link_ids, is_besteff=is_besteff)
         else:
             return 0
 
 class Link:
-    def __init__(self, name, node_1, node_2, bandwidth, beff_frac, igp_metric):
+    def __init__(self, name, node_1, node_2, bandwidth, beff_frac, igp_metric, on_change=None, 
+                 state=None, length=None):
         self.name = name
         self.nodes = (node_1, node_2)
-        self.total_bandwidth = bandwidth
+        # Bandwidth bookkeeping lives in (shared) arrays; this object is a view on them
+        self.state = state or LinkState(capacity=1)
+        self.id = self.state.add(bandwidth, beff_frac)
         self.beff_frac = beff_frac
-        self.prio_bandwidth = bandwidth*(1 - self.beff_frac)
-        self.beff_bandwidth = bandwidth*(self.beff_frac)
         self.igp_metric = igp_metric
-        self.n_besteffs = 0
-        self.is_spur = False
-        self.__length = distance(node_1.lat, node_2.lat, node_1.lon, node_2.lon)
-        
+        self.on_change = on_change
+        self.__is_spur = False
+        if length is None:
+            length = distance(node_1.lat, node_2.lat, node_1.lon, node_2.lon)
+        self.__length = length
+
+    @property
+    def total_bandwidth(self):
+        return float(self.state.total_bandwidth[self.id])
+
+    @property
+    def prio_bandwidth(self):
+        return float(self.state.prio_bandwidth[self.id])
+
+    @prio_bandwidth.setter
+    def prio_bandwidth(self, bandwidth):
+        self.state.prio_bandwidth[self.id] = bandwidth
+
+    @property
+    def beff_bandwidth(self):
+        return float(self.state.beff_bandwidth[self.id])
+
+    @beff_bandwidth.setter
+    def beff_bandwidth(self, bandwidth):
+        self.state.beff_bandwidth[self.id] = bandwidth
+
+    @property
+    def n_besteffs(self):
+        return int(self.state.n_besteffs[self.id])
+
+    @n_besteffs.setter
+    def n_besteffs(self, n_besteffs):
+        self.state.n_besteffs[self.id] = n_besteffs
+
+    @property
+    def is_spur(self):
+        return self.__is_spur
+
+    @is_spur.setter
+    def is_spur(self, is_spur):
+        if is_spur != self.__is_spur:
+            self.__is_spur = is_spur
+            # Link length changed, so notify the network
+            if self.on_change:
+                self.on_change(self)
+
     @property
     def length(self):
        if self.is_spur:
@@ -130,27 +191,10 @@ class Link:
         return f"Link({self.nodes})"
 
     def reserve(self, bandwidth, is_besteff=False):
-        orig_bandwidth = self.beff_bandwidth if is_besteff else self.prio_bandwidth
-        if orig_bandwidth - bandwidth < 0:
-            raise ValueError(
-                f"taking {bandwidth} exceeds free bandwidth ({orig_bandwidth})"
-            )
-        else:
-            if is_besteff:
-                self.beff_bandwidth -= bandwidth
-            else:
-                self.prio_bandwidth -= bandwidth
+        self.state.reserve(self.id, bandwidth, is_besteff=is_besteff)
 
     def free(self, bandwidth, is_besteff=False):
-        if self.beff_bandwidth + self.prio_bandwidth + bandwidth > self.total_bandwidth:
-            raise ValueError(
-                f"freeing {bandwidth} exceeds max bandwidth ({self.total_bandwidth})"
-            )
-        else:
-            if is_besteff:
-                self.beff_bandwidth += bandwidth
-            else:
-                self.prio_bandwidth += bandwidth
+        self.state.free(self.id, bandwidth, is_besteff=is_besteff)
 
 class Node:
     def __init__(self, name, lat, lon):
@@ -163,68 +207,97 @@ class Node:
         return f"Node({self.name})"
 
 class Network:
-    def __init__(self, network_json, coordinates_json, max_beff_passes=100, beff_frac=0.25):
+    def __init__(self, network_json, coordinates_json, beff_frac=0.25, route_cache_size=1024, 
+                 utilization=None, topology_snapshot=None, clock=None):
+        # Virtual clock (a utils.vtime.Clock or Simulation; default: utils.vtime.now)
+        self.clock = clock
+        self.now = now if clock is None else clock.now
         self.__nodes = {}
         self.__links = {}
-        self.besteffs = []
-        self.max_beff_passes = max_beff_passes
-        with open(network_json, "r") as f:
-            adjacencies = json.load(f).get("adjacencies")
-        with open(coordinates_json, "r") as m:
-            coordinates = json.load(m)
-        for adjacency in adjacencies:
-            # Initialize or look up start node
-            start_name = adjacency.get("a")
-            start_lat, start_lon = coordinates[start_name]
-            if not self.has_node(start_name):
-                start_node = Node(start_name, start_lat, start_lon)
-                self.add_node(start_node)
-            else:
-                start_node = self.get_node(start_name)
-            # Initialize or look up end node
-            end_name = adjacency.get("z")
-            end_lat, end_lon = coordinates[end_name]
-            if not self.has_node(end_name):
-                end_node = Node(end_name, end_lat, end_lon)
-                self.add_node(end_node)
-            else:
-                end_node = self.get_node(end_name)
-            # Resolve neighbors
-            if end_node not in start_node.neighbors:
-                start_node.neighbors.append(end_node)
-            if start_node not in end_node.neighbors:
-                end_node.neighbors.append(start_node)
-            # Initialize link
+        # adjacency[node name][neighbor name] = parallel links between the two nodes
+        self.__adjacency = {}
+        # route_cache[(start node name, end node name, algo)] = (start node, end node,
+        #     [(from node, to node) for every hop]), least recently used first
+        self.__route_cache = OrderedDict()
+        self.__route_cache_lock = Lock()
+        self.route_cache_size = route_cache_size
+        self.link_state = LinkState()
+        # Keyword arguments for the UtilizationRecorder (None: do not record utilization)
+        if utilization is None:
+            self.utilization = None
+        else:
+            self.utilization = UtilizationRecorder(self.link_state, **utilization)
+        # besteffs and link_besteffs[link ID] are insertion-ordered sets of BestEfforts
+        self.besteffs = {}
+        self.__link_besteffs = {}
+        topology = load_topology(network_json, coordinates_json, snapshot=topology_snapshot)
+        nodes = [
+            Node(name, lat, lon) for name, lat, lon in zip(
+                topology.node_names.tolist(), 
+                topology.node_lat.tolist(), 
+                topology.node_lon.tolist()
+            )
+        ]
+        indptr = topology.node_indptr.tolist()
+        indices = topology.node_indices.tolist()
+        for node_i, node in enumerate(nodes):
+            node.neighbors = [nodes[j] for j in indices[indptr[node_i]:indptr[node_i + 1]]]
+            self.add_node(node)
+        for name, (start_i, end_i), mbps, igp_metric, length in zip(
+            topology.link_names.tolist(),
+            topology.link_nodes.tolist(),
+            topology.link_mbps.tolist(),
+            topology.link_igp.tolist(),
+            topology.link_length.tolist()
+        ):
+            # Missing IGP metrics are stored as NaN
             new_link = Link(
-                adjacency.get("id"), 
-                start_node, 
-                end_node, 
-                adjacency.get("mbps"), 
+                name, 
+                nodes[start_i], 
+                nodes[end_i], 
+                mbps, 
                 beff_frac,
-                adjacency.get("igpMetric")
+                None if np.isnan(igp_metric) else igp_metric,
+                on_change=self.invalidate_routes,
+                state=self.link_state,
+                length=length
             )
             self.add_link(new_link)
 
+        # Pre-sort parallel links so that the best link is (usually) the first one
+        for neighbors in self.__adjacency.values():
+            for links in neighbors.values():
+                links.sort(key=lambda link: link.prio_bandwidth, reverse=True)
+
     def add_link(self, link):
         self.__links[link.name] = link
+        node_1, node_2 = link.nodes
+        self.__adjacency.setdefault(node_1.name, {}).setdefault(node_2.name, []).append(link)
+        self.__adjacency.setdefault(node_2.name, {}).setdefault(node_1.name, []).append(link)
 
     def get_link(self, link_name):
         return self.__links[link_name]
 
     def find_links(self, node_1, node_2, best_only=False):
-        links = []
-        for link in self.links():
-            if set([node_1, node_2]) == set(link.nodes):
-                links.append(link)
-
-        if len(links) == 0:
+        links = self.__adjacency.get(node_1.name, {}).get(node_2.name)
+        if not links:
             raise KeyError(f"no link connecting {node_1.name} and {node_2.name}")
 
-        links.sort(key=lambda link: link.prio_bandwidth, reverse=True)
         if best_only:
+            return self.__best_link(links)
+        else:
+            return sorted(links, key=lambda link: link.prio_bandwidth, reverse=True)
+
+    @staticmethod
+    def __best_link(links):
+        """
+        Returns the parallel link with the most free prioritized bandwidth; the links 
+        are pre-sorted, so this is only a scan when the original ordering has changed
+        """
+        if len(links) == 1:
             return links[0]
         else:
-            return links
+            return max(links, key=lambda link: link.prio_bandwidth)
 
     def links(self, names=False):
         if names:
@@ -265,69 +338,146 @@ class Network:
         else:
             return BestEffort(self, route)
 
-    def distrib_besteff(self, besteff=None):
+    def distrib_besteff(self, besteff=None, t=None):
+        """
+        Register a new best effort (if given) and redistribute best-effort bandwidth 
+        max-min fairly as of time t (default: now); only the best efforts that share 
+        links (transitively) with the new one are touched, otherwise all of them are 
+        redistributed
+        """
         if besteff:
-            self.besteffs.append(besteff)
-        
-        # Reset all active links
-        for besteff in self.besteffs:
-            for link in besteff.route.links:
-                link.n_besteffs = 0
-                link.beff_bandwidth = link.total_bandwidth*link.beff_frac
-        
-        # Register each besteff at all of its links
-        for besteff in self.besteffs:
-            for link in besteff.route.links:
-                link.n_besteffs += 1
-
-        # Attempt to maximize all besteff bandwidths
-        total_besteff_shares = [0. for besteff in self.besteffs]
-        besteff_queue = list(self.besteffs)
-        n_passes = 0
-        while len(besteff_queue) > 0 and n_passes <= self.max_beff_passes:
-            # Resolve any besteff that has received maximal capacity
-            finished_besteffs = []
-            for beff_i, besteff in enumerate(besteff_queue):
-                if besteff.route.get_capacity(is_besteff=True) == 0:
-                    finished_besteffs.append(besteff)
-                    # Update bandwidth for this besteff
-                    besteff.update(total_besteff_shares[beff_i])
-                    # Deregister this besteff at each link in its route
-                    for link in besteff.route.links:
-                        link.n_besteffs -= 1
-
-            # Remove finished besteffs from queue
-            for besteff in finished_besteffs:
-                beff_i = besteff_queue.index(besteff)
-                besteff_queue.pop(beff_i)
-                total_besteff_shares.pop(beff_i)
-
-            # Find then remaining bandwidth along this besteff's route
-            new_besteff_shares = [0. for besteff in besteff_queue]
-            for beff_i, besteff in enumerate(besteff_queue):
-                beff_share = besteff.route.get_capacity(is_besteff=True)
-                new_besteff_shares[beff_i] = beff_share
-
-            # Reserve this besteff's share of the remainder
-            for beff_i, besteff in enumerate(besteff_queue):
-                new_beff_share = new_besteff_shares[beff_i]
-                total_besteff_shares[beff_i] += new_beff_share
-                for link in besteff.route.links:
-                    link.reserve(new_beff_share, is_besteff=True)
-
-            n_passes += 1
-
-    def release_besteff(self, besteff):
-        self.besteffs.remove(besteff)
-        self.distrib_besteff()
+            self.besteffs[besteff] = None
+            for link_id in besteff.route.link_ids.tolist():
+                self.__link_besteffs.setdefault(link_id, {})[besteff] = None
+            self.__reallocate_besteffs(besteff.route.link_ids.tolist(), t=t)
+        else:
+            self.__reallocate_besteffs(list(self.__link_besteffs.keys()), t=t)
+
+    def release_besteff(self, besteff, t=None):
+        del self.besteffs[besteff]
+        for link_id in besteff.route.link_ids.tolist():
+            link_besteffs = self.__link_besteffs[link_id]
+            del link_besteffs[besteff]
+            if len(link_besteffs) == 0:
+                del self.__link_besteffs[link_id]
+        self.__reallocate_besteffs(besteff.route.link_ids.tolist(), t=t)
+
+    @timed
+    def __reallocate_besteffs(self, link_ids, t=None):
+        """
+        Recompute the best-effort allocation of every best effort connected to the 
+        given links, as of time t (default: now)
+        """
+        component_link_ids, besteffs = connected_flows(
+            link_ids, 
+            self.__link_besteffs, 
+            lambda besteff: besteff.route.link_ids.tolist()
+        )
+        link_ids = np.array(sorted(component_link_ids), dtype=np.int64)
+        # Build the link x best effort incidence matrix for this component
+        besteff_link_ids = [besteff.route.link_ids for besteff in besteffs]
+        entry_besteffs = np.repeat(
+            np.arange(len(besteffs)), 
+            [len(ids) for ids in besteff_link_ids]
+        )
+        if len(besteffs) > 0:
+            entry_links = np.searchsorted(link_ids, np.concatenate(besteff_link_ids))
+        else:
+            entry_links = np.zeros(0, dtype=np.int64)
+        capacities = self.link_state.beff_capacity[link_ids]
+        shares = max_min_fair(entry_besteffs, entry_links, capacities, len(besteffs))
+        # Update link accounting
+        reserved = np.bincount(
+            entry_links, 
+            weights=shares[entry_besteffs], 
+            minlength=len(link_ids)
+        )
+        self.link_state.n_besteffs[link_ids] = np.bincount(entry_links, minlength=len(link_ids))
+        self.link_state.beff_bandwidth[link_ids] = np.maximum(capacities - reserved, 0.)
+        if self.utilization:
+            self.utilization.record(link_ids, self.now() if t is None else t)
+        # Update bandwidth of each best effort whose share changed
+        n_updates = 0
+        for besteff, share in zip(besteffs, shares.tolist()):
+            if share != besteff.bandwidth:
+                besteff.update(share, t=t)
+                n_updates += 1
+        BESTEFF_PASSES.inc()
+        BESTEFF_UPDATES.inc(n_updates)
 
     def fulfill_promise(self, promise):
-        for link in promise.route.links:
-            link.reserve(promise.bandwidth)
+        self.link_state.reserve(promise.route.link_ids, promise.bandwidth)
+        if self.utilization:
+            self.utilization.record(promise.route.link_ids, promise.start_time)
 
     def release_promise(self, promise):
-        for link in promise.route.links:
-            link.free(promise.bandwidth)
+        self.link_state.free(promise.route.link_ids, promise.bandwidth)
+        if self.utilization:
+            self.utilization.record(promise.route.link_ids, promise.end_time)
+
+    def get_route(self, start_node_name, end_node_name, algo="dijkstra"):
+        """
+        Returns the shortest route between two nodes, computing it with the given 
+        algorithm (currently: dijkstra, A_star) only if it is not already cached
+
+        N.B. only the path (the sequence of nodes) is cached: the parallel link with 
+        the most free prioritized bandwidth is picked again for every hop on each hit; 
+        cached paths are never modified, so cache hits do not take the cache lock
+        """
+        key = (start_node_name, end_node_name, algo)
+        path = self.__route_cache.get(key)
+        if path is not None:
+            try:
+                self.__route_cache.move_to_end(key)
+            except KeyError:
+                pass # evicted or invalidated in the meantime
+            ROUTE_CACHE_HITS.inc()
+            start_node, end_node, hops = path
+            return Route(
+                start_node=start_node, 
+                end_node=end_node, 
+                links=[self.find_links(node_1, node_2, best_only=True) for node_1, node_2 in hops]
+            )
+
+        ROUTE_COMPUTATIONS.inc(algo=algo)
+        route = getattr(self, algo)(start_node_name, end_node_name)
+        if route is not None and self.route_cache_size > 0:
+            with self.__route_cache_lock:
+                self.__route_cache[key] = (route.start_node, route.end_node, self.__hops(route))
+                if len(self.__route_cache) > self.route_cache_size:
+                    self.__route_cache.popitem(last=False)
+
+        return route
+
+    @staticmethod
+    def __hops(route):
+        """
+        Returns the (from node, to node) pairs that the links of a route connect, in order
+        """
+        hops = []
+        this_node = route.start_node
+        for link in route.links:
+            node_1, node_2 = link.nodes
+            next_node = node_2 if node_1.name == this_node.name else node_1
+            hops.append((this_node, next_node))
+            this_node = next_node
+        return hops
+
+    def warm_route_cache(self, node_names, algo="dijkstra"):
+        """
+        Fill the route cache for every ordered pair of the given nodes
+        """
+        for start_node_name in node_names:
+            for end_node_name in node_names:
+                if start_node_name != end_node_name:
+                    self.get_route(start_node_name, end_node_name, algo=algo)
+
+    def invalidate_routes(self, link=None):
+        """
+        Drop every cached route; called whenever the length of any link changes
+        """
+        with self.__route_cache_lock:
+            self.__route_cache.clear()
 
     def get_route_from_id(self, route_id):
         link_names = base64.b64decode(route_id.encode("utf-8")).decode("utf-8").split("&")
@@ -356,13 +506,7 @@ class Network:
         """
         return distance(node.lat, end_node.lat, node.lon, end_node.lon)
 
-    def __A_star_g(self, node, prev_node):
-        """
-        Returns the actual cost of going from the previous node to the current node
-        """
-        link = self.find_links(prev_node, node, best_only=True)
-        return link.length
-
+    @timed
     def A_star(self, start_node_name, end_node_name):
         """
         A* algorithm for finding the shortest path between two nodes in the network. 
@@ -377,7 +521,9 @@ class Network:
         start_node = self.get_node(start_node_name)
         end_node = self.get_node(end_node_name)
 
-        queue = [start_node]
+        # Binary heap of (f score, node name); stale entries are skipped when popped
+        queue = [(self.__A_star_h(start_node, end_node), start_node_name)]
+        closed = set()
 
         # prev[n] = is the node immediately preceding n on the cheapest path from start 
         #           currently known
@@ -386,109 +532,192 @@ class Network:
         # g_scores[n] = actual cost of the cheapest path from start to n 
         g_scores = {start_node_name: 0}
 
-        # f_scores[n] = approximately how cheap a path could be from start to finish if 
-        #               it goes through n 
-        f_scores = {start_node_name: self.__A_star_h(start_node, end_node)}
-
         while len(queue) != 0:
             # Select the 'closest' node (i.e. node with minimal f score)
-            queue.sort(key=lambda node: f_scores[node.name])
-            this_node = queue.pop(0)
-            if this_node.name == end_node.name:
+            _, this_node_name = heappop(queue)
+            if this_node_name in closed:
+                continue
+            elif this_node_name == end_node_name:
                 # Success
                 return self.__reconstruct_route(end_node_name, prev)
-            else:
-                # Check neighbors
-                for next_node in this_node.neighbors:
-                    g_score = (
-                        g_scores[this_node.name] 
-                        + self.__A_star_g(next_node, this_node)
-                    )
-                    if next_node.name not in g_scores or g_score < g_scores[next_node.name]:
-                        # This path is better than any previous one
-                        prev[next_node.name] = this_node
-                        g_scores[next_node.name] = g_score
-                        f_scores[next_node.name] = (
-                            g_score 
-                            + self.__A_star_h(next_node, end_node)
-                        )
-                        if next_node not in queue:
-                            queue.append(next_node)
 
+            closed.add(this_node_name)
+            this_node = self.__nodes[this_node_name]
+            # Check neighbors
+            for next_node_name, links in self.__adjacency[this_node_name].items():
+                if next_node_name in closed:
+                    continue
+                g_score = g_scores[this_node_name] + self.__best_link(links).length
+                if next_node_name not in g_scores or g_score < g_scores[next_node_name]:
+                    # This path is better than any previous one
+                    next_node = self.__nodes[next_node_name]
+                    prev[next_node_name] = this_node
+                    g_scores[next_node_name] = g_score
+                    f_score = g_score + self.__A_star_h(next_node, end_node)
+                    heappush(queue, (f_score, next_node_name))
+
+        return None
+
+    @timed
     def dijkstra(self, start_node_name, end_node_name):
         """
         Dijkstra's algorithm for finding the shortest route between two nodes in the 
         network
         """
-        start_node = self.get_node(start_node_name)
+        self.get_node(start_node_name)
+        self.get_node(end_node_name)
         # Initialize Dijkstra variables
-        dist = {}
-        prev = {}
-        queue = []
-        for node in self.nodes():
-            if node == start_node:
-                dist[node.name] = 0
-            else:
-                dist[node.name] = INFINITY
-            prev[node.name] = None
-            queue.append(node)
+        dist = {start_node_name: 0}
+        prev = {start_node_name: None}
+        visited = set()
+        queue = [(0, start_node_name)]
 
         while len(queue) > 0:
-            # Find closest node
-            min_dist = INFINITY
-            min_dist_node = None
-            for node in queue:
-                if dist[node.name] < min_dist:
-                    min_dist = dist[node.name]
-                    min_dist_node = node
-                    
-            if min_dist_node == None:
-                return None 
-
-            # Remove closest node from queue
-            this_node = min_dist_node
-            queue.remove(min_dist_node)
-            
-            if this_node.name == end_node_name:
+            # Pop closest node; stale heap entries are skipped
+            this_dist, this_node_name = heappop(queue)
+            if this_node_name in visited:
+                continue
+            elif this_node_name == end_node_name:
                 return self.__reconstruct_route(end_node_name, prev)
 
+            visited.add(this_node_name)
+            this_node = self.__nodes[this_node_name]
             # Evaluate distances from closest node to its neighbors
-            for next_node in [n for n in this_node.neighbors if n in queue]:
-                link = self.find_links(this_node, next_node, best_only=True)
-                alt = dist[this_node.name] + link.length
-                if alt < dist[next_node.name] and dist[this_node.name] != INFINITY:
-                    dist[next_node.name] = alt
-                    prev[next_node.name] = this_node
+            for next_node_name, links in self.__adjacency[this_node_name].items():
+                if next_node_name in visited:
+                    continue
+                alt = this_dist + self.__best_link(links).length
+                if alt < dist.get(next_node_name, INFINITY):
+                    dist[next_node_name] = alt
+                    prev[next_node_name] = this_node
+                    heappush(queue, (alt, next_node_name))
+
+        return None
+
+    def __shortest_distances(self, start_node_name):
+        """
+        Returns the shortest distance from the given node to every node that it can 
+        reach (i.e. the full Dijkstra shortest-path tree)
+        """
+        dist = {start_node_name: 0}
+        visited = set()
+        queue = [(0, start_node_name)]
+        while len(queue) > 0:
+            this_dist, this_node_name = heappop(queue)
+            if this_node_name in visited:
+                continue
+            visited.add(this_node_name)
+            for next_node_name, links in self.__adjacency[this_node_name].items():
+                alt = this_dist + self.__best_link(links).length
+                if next_node_name not in visited and alt < dist.get(next_node_name, INFINITY):
+                    dist[next_node_name] = alt
+                    heappush(queue, (alt, next_node_name))
+
+        return dist
+
+    def __spur_search(self, spur_node_name, end_node_name, removed_nodes, removed_edges, 
+                      to_end):
+        """
+        A* search from a spur node to the end node that avoids the given nodes and 
+        (directed) edges. The exact distances to the end node in the full network are 
+        used as the heuristic; they are admissible because removing nodes and edges can 
+        only make routes longer. Returns (cost, node names) or None.
+        """
+        queue = [(to_end[spur_node_name], 0, spur_node_name)]
+        g_scores = {spur_node_name: 0}
+        prev = {spur_node_name: None}
+        closed = set()
+        while len(queue) > 0:
+            _, g_score, this_node_name = heappop(queue)
+            if this_node_name in closed:
+                continue
+            elif this_node_name == end_node_name:
+                path = [end_node_name]
+                while prev[path[-1]] != None:
+                    path.append(prev[path[-1]])
+                return g_score, path[::-1]
+
+            closed.add(this_node_name)
+            for next_node_name, links in self.__adjacency[this_node_name].items():
+                if (next_node_name in closed 
+                    or next_node_name in removed_nodes 
+                    or next_node_name not in to_end 
+                    or (this_node_name, next_node_name) in removed_edges):
+                    continue
+                alt = g_score + self.__best_link(links).length
+                if alt < g_scores.get(next_node_name, INFINITY):
+                    g_scores[next_node_name] = alt
+                    prev[next_node_name] = this_node_name
+                    heappush(queue, (alt + to_end[next_node_name], alt, next_node_name))
+
+        return None
+
+    def __route_from_nodes(self, node_names):
+        route = Route(
+            start_node=self.get_node(node_names[0]), 
+            end_node=self.get_node(node_names[-1])
+        )
+        for node_name, next_node_name in zip(node_names[:-1], node_names[1:]):
+            links = self.__adjacency[node_name][next_node_name]
+            route.links.append(self.__best_link(links))
 
         return route
 
+    @timed
     def find_routes(self, start_node_name, end_node_name, n_routes=1, algo="dijkstra"):
         """
-        Find the N shortest routes (default: 1) between a start and end node in the 
-        network using Yen's K shortest paths algorithm with any algorithm implemented 
-        in Network (currently: Dijkstra, A*)
+        Find the N shortest loopless routes (default: 1) between a start and end node in 
+        the network, ranked by cost, using Yen's K shortest paths algorithm. The first 
+        route is found with any algorithm implemented in Network (currently: Dijkstra, 
+        A*); every spur search is an A* search guided by a single shared shortest-path 
+        tree rooted at the end node, and candidate routes are kept in a heap.
         """
-        route_algo = getattr(self, algo)
+        shortest_route = getattr(self, algo)(start_node_name, end_node_name)
+        if not shortest_route:
+            return []
+
+        to_end = self.__shortest_distances(end_node_name)
+
+        # Node names along the shortest route
+        shortest_path = [start_node_name]
+        for link in shortest_route.links:
+            node_1, node_2 = link.nodes
+            shortest_path.append(node_2.name if node_1.name == shortest_path[-1] else node_1.name)
 
-        shortest_route = route_algo(start_node_name, end_node_name)
-        spur_routes = []
         shortest_routes = [shortest_route]
-        shortest_route_ids = [shortest_route.id]
-                
-        for i in range(1, len(shortest_route)):
-            for j in range(len(shortest_route)):
-                spur_routes.append(shortest_route.links[j:j+i])
-
-        for spur_route in spur_routes[:n_routes]:
-            for link in spur_route:
-                link.is_spur = True  
-            next_route = route_algo(start_node_name, end_node_name)
-            if next_route.id not in shortest_route_ids:
-                shortest_routes.append(next_route)
-                shortest_route_ids.append(next_route.id)
-            for link in spur_route:
-                link.is_spur = False
-
-        shortest_routes.sort(key=lambda route: sum([link.length for link in route.links]))
+        shortest_paths = [shortest_path]
+        candidates = []
+        seen_paths = {tuple(shortest_path)}
+        while len(shortest_routes) < n_routes:
+            last_path = shortest_paths[-1]
+            last_route = shortest_routes[-1]
+            root_cost = 0
+            for spur_i, spur_node_name in enumerate(last_path[:-1]):
+                root_path = last_path[:spur_i + 1]
+                # Remove the next edge of every known route that shares this root
+                removed_edges = set()
+                for path in shortest_paths:
+                    if path[:spur_i + 1] == root_path:
+                        removed_edges.add((path[spur_i], path[spur_i + 1]))
+                # Remove the root nodes (except the spur node) to keep routes loopless
+                removed_nodes = set(root_path[:-1])
+                spur = self.__spur_search(
+                    spur_node_name, end_node_name, removed_nodes, removed_edges, to_end
+                )
+                if spur:
+                    spur_cost, spur_path = spur
+                    path = root_path[:-1] + spur_path
+                    if tuple(path) not in seen_paths:
+                        seen_paths.add(tuple(path))
+                        heappush(candidates, (root_cost + spur_cost, len(seen_paths), path))
+
+                root_cost += last_route.links[spur_i].length
+
+            if len(candidates) == 0:
+                break
+
+            _, _, path = heappop(candidates)
+            shortest_paths.append(path)
+            shortest_routes.append(self.__route_from_nodes(path))
 
         return shortest_routes
@@ -0,0 +1,372 @@
+import logging
+import weakref
+import itertools
+import numpy as np
+from heapq import heappush, heappop
+from collections import deque, OrderedDict
+from threading import Lock, RLock, Condition
+
+from utils.vtime import now
+from utils.metrics import REGISTRY, timed, sum_readings
+from northbound.vsnet.connection import Connection
+from northbound.vsnet.network import Network
+
+# Every VSNet of this process (normally just one), as reported by the gauges below
+VSNETS = weakref.WeakSet()
+
+REGISTRY.gauge(
+    "vsnet_active_connections", "Connections that are transferring data", 
+    func=lambda: sum_readings(vsnet.n_active_connections() for vsnet in list(VSNETS))
+)
+REGISTRY.gauge(
+    "vsnet_links_at_capacity", "Links with no bandwidth left, by bandwidth class",
+    labelnames=("class",), 
+    func=lambda: sum_readings(vsnet.n_links_at_capacity() for vsnet in list(VSNETS))
+)
+
+class VSNet:
+    """
+    VSNet connection bookkeeping on top of a Network; served over HTTP by the VSNet
+    API, or used in-process by Burro when it runs as a discrete-event simulation.
+
+    Every change to connections or to the bandwidth on the network is made while 
+    holding self.lock, so calls from several threads are serialized. Reads do not take 
+    it: routes are served from the (immutable) cached routes, and the history from 
+    summaries of the connections that are replaced, never modified, on every change.
+
+    Finished connections are compacted: only their summary is kept, and only for as 
+    long as the retention policy (history_size, history_retention) allows.
+    """
+    def __init__(self, vsnet_config, clock=None):
+        self.sites = vsnet_config["sites"]
+        # Virtual clock (a utils.vtime.Clock or Simulation; default: utils.vtime.now)
+        self.clock = clock
+        self.now = now if clock is None else clock.now
+        if "max_beff_passes" in vsnet_config:
+            logging.warning(
+                "max_beff_passes is deprecated and ignored: best-effort bandwidth is "
+                "distributed exactly, in a single pass"
+            )
+        self.network = Network(
+            vsnet_config["network_json"],
+            vsnet_config["coordinates_json"],
+            beff_frac=vsnet_config.get("beff_frac", 0.25),
+            route_cache_size=vsnet_config.get("route_cache_size", 1024),
+            utilization=vsnet_config.get("utilization", {}),
+            topology_snapshot=vsnet_config.get("topology_snapshot", None),
+            clock=clock
+        )
+        self.connections = {}
+        # history[connection ID] = latest Connection.summary(), oldest revision first
+        self.__history = OrderedDict()
+        self.__n_revisions = 0
+        self.__history_lock = Lock()
+        # finished[connection ID] = end time, in the order in which connections finished
+        self.__finished = OrderedDict()
+        self.history_size = vsnet_config.get("history_size", 100000)
+        self.history_retention = vsnet_config.get("history_retention", None)
+        # Min-heap of (projected end time, connection ID); entries whose end time has 
+        # since moved are skipped when they come up
+        self.__end_times = []
+        self.lock = RLock()
+        # Most recent connection events, numbered from 1, for subscribers (see events)
+        self.__events = deque(maxlen=vsnet_config.get("event_buffer_size", 10000))
+        self.__n_events = 0
+        self.__events_changed = Condition(self.lock)
+        VSNETS.add(self)
+
+    def map(self, func, items):
+        """
+        Call func on every item; in-process calls are made one after the other (see 
+        southbound.vsnet_client.VSNetClient.map)
+        """
+        return [func(item) for item in items]
+
+    def warm_route_cache(self):
+        self.network.warm_route_cache(set(self.sites.values()))
+
+    def find_connection(self, connection_id):
+        if connection_id not in self.connections:
+            raise KeyError(f"connection with {connection_id} not found")
+        else:
+            return self.connections[connection_id]
+
+    def is_finished(self, connection_id):
+        return connection_id in self.__finished
+
+    def history(self, cursor=0, since=None, limit=None):
+        """
+        Returns the latest summary of every connection that changed after the given 
+        cursor (and at or after virtual time since, if given), oldest change first, 
+        along with the cursor to pass next time; at most limit summaries are returned
+        """
+        records = []
+        with self.__history_lock:
+            # Records are ordered by revision, so only the changes after the cursor are read
+            for record in reversed(self.__history.values()):
+                if record["revision"] <= cursor:
+                    break
+                if since is not None and record["revised_at"] < since:
+                    break
+                records.append(record)
+            next_cursor = self.__n_revisions
+        records.reverse()
+        if limit is not None and len(records) > limit:
+            records = records[:limit]
+            next_cursor = records[-1]["revision"]
+        return records, next_cursor
+
+    def __record(self, connection):
+        with self.__history_lock:
+            self.__n_revisions += 1
+            self.__history[connection.id] = {
+                **connection.summary(), 
+                "revision": self.__n_revisions, 
+                "revised_at": self.now()
+            }
+            self.__history.move_to_end(connection.id)
+
+    def __compact(self, connection):
+        """
+        Forget everything about a finished connection but its summary, then drop the 
+        oldest summaries that are past the retention policy
+        """
+        del self.connections[connection.id]
+        self.__finished[connection.id] = connection.end_time
+        with self.__history_lock:
+            while len(self.__finished) > 0:
+                connection_id, end_time = next(iter(self.__finished.items()))
+                is_expired = (
+                    self.history_retention is not None 
+                    and end_time < connection.end_time - self.history_retention
+                )
+                if len(self.__finished) <= self.history_size and not is_expired:
+                    break
+                del self.__finished[connection_id]
+                self.__history.pop(connection_id, None)
+
+    def __on_connection_change(self, connection):
+        self.__record(connection)
+        if connection.is_finished:
+            self.__compact(connection)
+        if connection.projected_end_time is not None:
+            heappush(self.__end_times, (connection.projected_end_time, connection.id))
+        self.__n_events += 1
+        if connection.is_finished:
+            event = {"type": "finished", "time": connection.end_time}
+        else:
+            event = {
+                "type": "bandwidth", 
+                "bandwidth": connection.bandwidth, 
+                "projected_end_time": connection.projected_end_time
+            }
+        self.__events.append({"seq": self.__n_events, "connection_id": connection.id, **event})
+        self.__events_changed.notify_all()
+
+    def events(self, after=0, timeout=0.):
+        """
+        Returns the connection events (completions and bandwidth changes) numbered after 
+        the given sequence number, waiting up to timeout seconds for one to happen; 
+        "missed" is set if older events have already been dropped from the buffer, or if
+        the sequence number is ahead of VSNet's (i.e. VSNet has restarted since)
+        """
+        with self.__events_changed:
+            self.__events_changed.wait_for(lambda: self.__n_events != after, timeout)
+            first_seq = self.__n_events - len(self.__events) + 1
+            return {
+                "events": list(itertools.islice(self.__events, max(after + 1 - first_seq, 0), None)),
+                "last_seq": self.__n_events,
+                "missed": after + 1 < first_seq or after > self.__n_events
+            }
+
+    def __is_current(self, end_time, connection_id):
+        connection = self.connections.get(connection_id)
+        return (
+            connection is not None 
+            and connection.is_active 
+            and connection.projected_end_time == end_time
+        )
+
+    def next_end_time(self):
+        """
+        Returns the earliest projected end time of any active connection (None if no 
+        connection is projected to finish)
+        """
+        with self.lock:
+            while len(self.__end_times) > 0 and not self.__is_current(*self.__end_times[0]):
+                heappop(self.__end_times)
+            return self.__end_times[0][0] if len(self.__end_times) > 0 else None
+
+    def n_active_connections(self):
+        return sum(connection.is_active for connection in list(self.connections.values()))
+
+    def n_links_at_capacity(self, rtol=1e-6):
+        """
+        Returns the number of links whose prioritized bandwidth is all reserved, and 
+        of links whose best-effort bandwidth is all in use
+        """
+        state = self.network.link_state
+        n_links = state.n_links
+        total = state.total_bandwidth[:n_links]
+        prio_capacity = total*(1 - state.beff_frac[:n_links])
+        beff_capacity = total*state.beff_frac[:n_links]
+        prio_full = (prio_capacity > 0) & (state.prio_bandwidth[:n_links] <= rtol*prio_capacity)
+        beff_full = (
+            (state.n_besteffs[:n_links] > 0) 
+            & (state.beff_bandwidth[:n_links] <= rtol*beff_capacity)
+        )
+        return {("prioritized",): int(prio_full.sum()), ("best_effort",): int(beff_full.sum())}
+
+    @timed
+    def finalize(self, t=None):
+        """
+        Finish every connection projected to end at or before time t (default: now), in 
+        order of end time, freeing its bandwidth as of its end time
+        """
+        t = self.now() if t is None else t
+        with self.lock:
+            while len(self.__end_times) > 0 and self.__end_times[0][0] <= t:
+                end_time, connection_id = heappop(self.__end_times)
+                if self.__is_current(end_time, connection_id):
+                    # Freeing bandwidth can pull other end times forward (onto the heap)
+                    self.connections[connection_id].finish(end_time)
+
+    def __link_names(self):
+        names = [None]*self.network.link_state.n_links
+        for link in self.network.links():
+            names[link.id] = link.name
+        return names
+
+    def get_link_utilization(self, link_name, start=None, end=None):
+        link = self.network.get_link(link_name)
+        return {
+            "link": link_name,
+            "prio_capacity": link.total_bandwidth*(1 - link.beff_frac),
+            "beff_capacity": link.total_bandwidth*link.beff_frac,
+            **self.network.utilization.query(link.id, start=start, end=end)
+        }
+
+    def get_congested_links(self, n_links=10, start=None):
+        """
+        Returns the links with the highest peak utilization (prioritized or best 
+        effort, as a fraction of capacity) since start
+        """
+        prio, beff = self.network.utilization.peaks(start=start)
+        names = self.__link_names()
+        ranking = np.argsort(-np.maximum(prio, beff), kind="stable")[:n_links]
+        return [
+            {"link": names[i], "prio_peak": float(prio[i]), "beff_peak": float(beff[i])}
+            for i in ranking.tolist()
+        ]
+
+    def export_utilization(self, path):
+        self.network.utilization.export(path, self.__link_names())
+
+    def get_route(self, src, dst):
+        route = self.network.get_route(self.sites[src], self.sites[dst])
+        return {
+            "route_id": route.id,
+            "capacity": route.get_capacity()
+        }
+
+    def get_ranked_routes(self, src, dst, n_routes=5):
+        routes = self.network.find_routes(self.sites[src], self.sites[dst], n_routes=n_routes)
+        return [
+            {"route_id": route.id, "cost": route.cost, "capacity": route.get_capacity()}
+            for route in routes
+        ]
+
+    def check_connection(self, connection_id):
+        with self.lock:
+            self.finalize()
+            if self.is_finished(connection_id):
+                return {"is_finished": True, "remaining_time": None}
+            connection = self.find_connection(connection_id)
+            return {
+                "is_finished": connection.is_finished,
+                "remaining_time": connection.compute_remaining_time()
+            }
+
+    def create_connection(self, burro_id, src, dst, total_data):
+        connection_id = f"{burro_id}_{src}_{dst}"
+        with self.lock:
+            connection = Connection(
+                connection_id, 
+                total_data, 
+                on_change=self.__on_connection_change,
+                clock=self.clock
+            )
+            self.connections[connection_id] = connection
+            self.__finished.pop(connection_id, None)
+            self.__record(connection)
+
+    def update_connection(self, connection_id, bandwidth, route_id):
+        with self.lock:
+            self.finalize()
+            if self.is_finished(connection_id):
+                return
+            connection = self.find_connection(connection_id)
+            promise = self.network.get_promise(route_id, bandwidth)
+            connection.update(promise)
+
+    def start_connection(self, connection_id):
+        with self.lock:
+            self.finalize()
+            # Every batch of a rule's transfers starts the same connection
+            if self.is_finished(connection_id):
+                return
+            connection = self.find_connection(connection_id)
+            if not connection.is_active:
+                connection.start()
+
+    @staticmethod
+    def __batch(func, items):
+        """
+        Call func on every item, collecting a result for each one; failures (of any 
+        kind) are reported per item instead of aborting the whole batch, since the 
+        items before them have already been applied
+        """
+        results = []
+        for item in items:
+            try:
+                result = func(item) or {}
+                results.append({"ok": True, **result})
+            except (KeyError, ValueError) as error:
+                results.append({"ok": False, "detail": str(error)})
+            except Exception as error:
+                results.append({"ok": False, "detail": f"{type(error).__name__}: {error}"})
+        return results
+
+    def get_routes(self, site_pairs):
+        return self.__batch(lambda pair: self.get_route(pair["src"], pair["dst"]), site_pairs)
+
+    def check_connections(self, connection_ids):
+        with self.lock:
+            return self.__batch(self.check_connection, connection_ids)
+
+    def create_connections(self, new_connections):
+        with self.lock:
+            return self.__batch(
+                lambda new_connection: self.create_connection(
+                    new_connection["burro_id"], 
+                    new_connection["src"], 
+                    new_connection["dst"], 
+                    new_connection["total_data"]
+                ), 
+                new_connections
+            )
+
+    def update_connections(self, updates):
+        with self.lock:
+            return self.__batch(
+                lambda update: self.update_connection(
+                    update["connection_id"], 
+                    update["bandwidth"], 
+                    update["route_id"]
+                ), 
+                updates
+            )
+
+    def start_connections(self, connection_ids):
+        with self.lock:
+            return self.__batch(self.start_connection, connection_ids)
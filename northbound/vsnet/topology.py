@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from math import radians, cos, sin, asin, sqrt
+
+SNAPSHOT_VERSION = 1
+
+def distance(lat1, lat2, lon1, lon2):
+     # Converts degrees to radians
+     lon1 = radians(lon1)
+     lon2 = radians(lon2)
+     lat1 = radians(lat1)
+     lat2 = radians(lat2)
+     # Uses Haversine formula then multiplies by 6371 KM (radius of Earth); for miles use 3956
+     km_distance = 2*asin(sqrt(
+         sin((lat2 - lat1)/2)**2
+         + cos(lat1)*cos(lat2)*sin((lon2 - lon1)/2)**2
+     ))*6371
+     return round(km_distance, 3)
+
+def source_hash(network_json, coordinates_json):
+    """
+    Returns the SHA-256 digest of the topology and coordinates JSON files
+    """
+    digest = hashlib.sha256()
+    for path in (network_json, coordinates_json):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+class Topology:
+    """
+    Compiled ESnet topology: node names and coordinates, links (as node indices) with
+    their capacity, IGP metric and precomputed length, and the adjacency in CSR form
+    (the neighbors of node i are node_indices[node_indptr[i]:node_indptr[i + 1]], in
+    the order in which they first appear in the topology JSON)
+    """
+    ARRAYS = [
+        "node_names", "node_lat", "node_lon", "link_names", "link_nodes", "link_mbps",
+        "link_igp", "link_length", "node_indptr", "node_indices"
+    ]
+
+    def __init__(self, source_hash, **arrays):
+        self.source_hash = source_hash
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def n_nodes(self):
+        return len(self.node_names)
+
+    @property
+    def n_links(self):
+        return len(self.link_names)
+
+    @classmethod
+    def compile(cls, network_json, coordinates_json):
+        """
+        Parse the topology and coordinates JSON files
+        """
+        with open(network_json, "r") as f:
+            adjacencies = json.load(f).get("adjacencies")
+        with open(coordinates_json, "r") as m:
+            coordinates = json.load(m)
+
+        # node_ids[node name] = index, in order of first appearance
+        node_ids = {}
+        # neighbors[node index] = insertion-ordered set of neighbor indices
+        neighbors = []
+        link_names, link_nodes, link_mbps, link_igp, link_length = [], [], [], [], []
+        for adjacency in adjacencies:
+            ends = []
+            for name in (adjacency.get("a"), adjacency.get("z")):
+                if name not in node_ids:
+                    node_ids[name] = len(node_ids)
+                    neighbors.append({})
+                ends.append(node_ids[name])
+            start_id, end_id = ends
+            neighbors[start_id].setdefault(end_id)
+            neighbors[end_id].setdefault(start_id)
+            start_lat, start_lon = coordinates[adjacency.get("a")]
+            end_lat, end_lon = coordinates[adjacency.get("z")]
+            igp_metric = adjacency.get("igpMetric")
+            link_names.append(adjacency.get("id"))
+            link_nodes.append(ends)
+            link_mbps.append(adjacency.get("mbps"))
+            link_igp.append(np.nan if igp_metric is None else igp_metric)
+            link_length.append(distance(start_lat, end_lat, start_lon, end_lon))
+
+        node_names = list(node_ids)
+        return cls(
+            source_hash(network_json, coordinates_json),
+            node_names=np.array(node_names, dtype=str),
+            node_lat=np.array([coordinates[name][0] for name in node_names], dtype=np.float64),
+            node_lon=np.array([coordinates[name][1] for name in node_names], dtype=np.float64),
+            link_names=np.array(link_names, dtype=str),
+            link_nodes=np.array(link_nodes, dtype=np.int64).reshape(-1, 2),
+            link_mbps=np.array(link_mbps, dtype=np.float64),
+            link_igp=np.array(link_igp, dtype=np.float64),
+            link_length=np.array(link_length, dtype=np.float64),
+            node_indptr=np.cumsum([0] + [len(n) for n in neighbors], dtype=np.int64),
+            node_indices=np.array([i for n in neighbors for i in n], dtype=np.int64)
+        )
+
+    def save(self, path):
+        """
+        Write the topology to an (uncompressed) NumPy archive at the given path; the
+        file is replaced atomically, so concurrent readers never see a partial snapshot
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    version=np.array(SNAPSHOT_VERSION),
+                    source_hash=np.array(self.source_hash),
+                    **{name: getattr(self, name) for name in self.ARRAYS}
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as snapshot:
+            if int(snapshot["version"]) != SNAPSHOT_VERSION:
+                raise ValueError(f"{path} has snapshot version {int(snapshot['version'])}")
+            return cls(str(snapshot["source_hash"]), **{name: snapshot[name] for name in cls.ARRAYS})
+
+def load_topology(network_json, coordinates_json, snapshot=None):
+    """
+    Returns the compiled topology, read from the snapshot at the given path if it was
+    compiled from the current JSON files; otherwise the JSON files are compiled and,
+    if a snapshot path is given, the snapshot is (re)written
+    """
+    if snapshot is None:
+        return Topology.compile(network_json, coordinates_json)
+
+    if os.path.exists(snapshot):
+        try:
+            topology = Topology.load(snapshot)
+        except (OSError, ValueError, KeyError):
+            topology = None
+        if topology and topology.source_hash == source_hash(network_json, coordinates_json):
+            return topology
+
+    topology = Topology.compile(network_json, coordinates_json)
+    try:
+        topology.save(snapshot)
+    except OSError:
+        # The snapshot is only a cache, so a read-only location just means recompiling
+        pass
+    return topology
@@ -0,0 +1,190 @@
+import numpy as np
+
+class UtilizationRecorder:
+    """
+    Per-link time series of prioritized and best-effort bandwidth in use, recorded
+    whenever an allocation changes. Samples are kept in fixed-size ring buffers (one
+    row per link), where each sample covers one time bucket and holds the peak and the
+    last value seen in it; changes within a bucket only update its sample in place.
+    There are n_tiers rings, each with buckets downsampling times as wide as the one
+    before, so recent history is kept at fine resolution and older history coarsely,
+    in constant memory.
+    """
+    COLUMNS = ["prio_peak", "prio_last", "beff_peak", "beff_last"]
+
+    def __init__(self, link_state, resolution=1000., n_samples=512, n_tiers=3, downsampling=16):
+        self.link_state = link_state
+        self.n_samples = n_samples
+        self.resolutions = [resolution*downsampling**tier_i for tier_i in range(n_tiers)]
+        self.n_records = 0
+        self.__n_rows = 0
+        # Per tier: bucket index of each sample (-1 if empty), index of the latest
+        # sample of each link, and one (links x samples) array per column
+        self.__buckets = [np.zeros((0, n_samples), dtype=np.int64) for _ in self.resolutions]
+        self.__heads = [np.zeros(0, dtype=np.int64) for _ in self.resolutions]
+        self.__columns = [
+            {column: np.zeros((0, n_samples), dtype=np.float32) for column in self.COLUMNS}
+            for _ in self.resolutions
+        ]
+
+    def __grow(self):
+        n_rows = max(self.link_state.n_links, 2*self.__n_rows)
+        n_new = n_rows - self.__n_rows
+        for tier_i in range(len(self.resolutions)):
+            self.__buckets[tier_i] = np.vstack([
+                self.__buckets[tier_i],
+                np.full((n_new, self.n_samples), -1, dtype=np.int64)
+            ])
+            # The first sample of a link goes into slot 0
+            self.__heads[tier_i] = np.concatenate([
+                self.__heads[tier_i],
+                np.full(n_new, self.n_samples - 1, dtype=np.int64)
+            ])
+            for column, array in self.__columns[tier_i].items():
+                self.__columns[tier_i][column] = np.vstack([
+                    array,
+                    np.zeros((n_new, self.n_samples), dtype=np.float32)
+                ])
+        self.__n_rows = n_rows
+
+    def in_use(self, link_ids):
+        """
+        Returns the prioritized and best-effort bandwidth in use on the given links
+        """
+        state = self.link_state
+        prio_capacity = state.total_bandwidth[link_ids]*(1 - state.beff_frac[link_ids])
+        beff_capacity = state.total_bandwidth[link_ids]*state.beff_frac[link_ids]
+        return (
+            prio_capacity - state.prio_bandwidth[link_ids],
+            beff_capacity - state.beff_bandwidth[link_ids]
+        )
+
+    def record(self, link_ids, t):
+        """
+        Record the current allocation on the given (distinct) links at time t
+        """
+        link_ids = np.asarray(link_ids, dtype=np.int64)
+        if len(link_ids) == 0:
+            return
+        if self.link_state.n_links > self.__n_rows:
+            self.__grow()
+
+        prio, beff = self.in_use(link_ids)
+        values = {"prio_peak": prio, "prio_last": prio, "beff_peak": beff, "beff_last": beff}
+        for tier_i, resolution in enumerate(self.resolutions):
+            bucket = int(t//resolution)
+            buckets = self.__buckets[tier_i]
+            heads = self.__heads[tier_i][link_ids]
+            is_new = buckets[link_ids, heads] != bucket
+            heads = np.where(is_new, (heads + 1) % self.n_samples, heads)
+            self.__heads[tier_i][link_ids] = heads
+            buckets[link_ids, heads] = bucket
+            for column, array in self.__columns[tier_i].items():
+                if column.endswith("peak"):
+                    array[link_ids, heads] = np.where(
+                        is_new,
+                        values[column],
+                        np.maximum(array[link_ids, heads], values[column])
+                    )
+                else:
+                    array[link_ids, heads] = values[column]
+        self.n_records += 1
+
+    def __pick_tier(self, start):
+        """
+        Returns the finest tier that still covers the given start time (or the
+        coarsest one)
+        """
+        for tier_i, resolution in enumerate(self.resolutions):
+            buckets = self.__buckets[tier_i]
+            oldest = buckets[buckets >= 0].min() if np.any(buckets >= 0) else 0
+            if start is None or oldest*resolution <= start:
+                return tier_i
+        return len(self.resolutions) - 1
+
+    def query(self, link_id, start=None, end=None, tier=None):
+        """
+        Returns the samples of a link between start and end (default: everything
+        kept), oldest first, from the given tier or from the finest tier that covers
+        start; each sample is (bucket start time, prio_peak, prio_last, beff_peak,
+        beff_last), where the values hold until the next sample
+        """
+        tier_i = self.__pick_tier(start) if tier is None else tier
+        resolution = self.resolutions[tier_i]
+        samples = {"resolution": resolution, "time": []}
+        samples.update({column: [] for column in self.COLUMNS})
+        if link_id >= self.__n_rows:
+            return samples
+        # Unroll the ring so that the oldest sample comes first
+        order = np.roll(np.arange(self.n_samples), -(int(self.__heads[tier_i][link_id]) + 1))
+        buckets = self.__buckets[tier_i][link_id, order]
+        times = buckets*resolution
+        keep = buckets >= 0
+        if start is not None:
+            # Keep the sample in effect at start as well
+            before = np.flatnonzero(keep & (times <= start))
+            keep &= (times > start)
+            if len(before) > 0:
+                keep[before[-1]] = True
+        if end is not None:
+            keep &= (times <= end)
+        samples["time"] = times[keep].tolist()
+        for column in self.COLUMNS:
+            samples[column] = self.__columns[tier_i][column][link_id, order][keep].tolist()
+        return samples
+
+    def peaks(self, start=None, tier=None):
+        """
+        Returns the peak prioritized and best-effort utilization (as a fraction of the
+        capacity) of every link since start, from the given tier or from the finest
+        tier that covers start
+        """
+        tier_i = self.__pick_tier(start) if tier is None else tier
+        n_links = self.link_state.n_links
+        prio = np.zeros(n_links)
+        beff = np.zeros(n_links)
+        if self.__n_rows > 0:
+            buckets = self.__buckets[tier_i][:n_links]
+            mask = buckets >= 0
+            if start is not None:
+                mask &= (buckets + 1)*self.resolutions[tier_i] > start
+            columns = self.__columns[tier_i]
+            prio = np.where(mask, columns["prio_peak"][:n_links], 0.).max(axis=1)
+            beff = np.where(mask, columns["beff_peak"][:n_links], 0.).max(axis=1)
+        state = self.link_state
+        total = state.total_bandwidth[:n_links]
+        beff_frac = state.beff_frac[:n_links]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            prio_capacity = total*(1 - beff_frac)
+            beff_capacity = total*beff_frac
+            return (
+                np.where(prio_capacity > 0, prio/prio_capacity, 0.),
+                np.where(beff_capacity > 0, beff/beff_capacity, 0.)
+            )
+
+    def export(self, path, link_names):
+        """
+        Write every tier to a compressed NumPy archive (.npz) at the given path (or
+        file), with one (links x samples) array per column and tier, named e.g.
+        "tier0_prio_peak"; samples are ordered oldest first
+        """
+        n_links = self.link_state.n_links
+        if self.__n_rows < n_links:
+            self.__grow()
+        arrays = {
+            "link_names": np.array(link_names),
+            "resolutions": np.array(self.resolutions),
+            "prio_capacity": self.link_state.total_bandwidth[:n_links]*(1 - self.link_state.beff_frac[:n_links]),
+            "beff_capacity": self.link_state.beff_capacity
+        }
+        for tier_i in range(len(self.resolutions)):
+            # Unroll every ring so that the oldest sample comes first
+            order = (
+                np.arange(self.n_samples)[None, :]
+                + self.__heads[tier_i][:n_links, None] + 1
+            ) % self.n_samples
+            rows = np.arange(n_links)[:, None]
+            arrays[f"tier{tier_i}_bucket"] = self.__buckets[tier_i][rows, order]
+            for column, array in self.__columns[tier_i].items():
+                arrays[f"tier{tier_i}_{column}"] = array[rows, order]
+        np.savez_compressed(path, **arrays)
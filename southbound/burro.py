@@ -1,38 +1,102 @@
 import os
+import sys
+import time
 import yaml
 import uuid
+import zlib
+import signal
 import logging
+import weakref
 import requests
-from multiprocessing.connection import Client
+from array import array
+from multiprocessing import current_process
 from threading import Thread, Event, Lock
 
-from utils.vtime import now, time_this
+from utils.vtime import now, time_this, get_time_dilation, Simulation, use_simulation
+from utils.metrics import REGISTRY, sum_readings
+from southbound.vsnet_client import VSNetClient
+from southbound.dmm_client import DMMClient
+
+STATES = ["PREPARING", "WAITING", "QUEUED", "SUBMITTED", "DONE", "DELETE"]
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+# Every Burro of this process (normally just one), as reported by the gauges below
+BURROS = weakref.WeakSet()
+
+REGISTRY.gauge(
+    "burro_transfers", "Transfers in each state", labelnames=("state",),
+    func=lambda: sum_readings(
+        {(state,): burro.transfers.count(state) for state in STATES} for burro in list(BURROS)
+    )
+)
+REGISTRY.gauge(
+    "burro_transfers_finished", "Transfers finished", 
+    func=lambda: sum_readings(burro.n_transfers_finished for burro in list(BURROS))
+)
+REGISTRY.gauge(
+    "burro_bytes_transferred", "Bytes transferred by finished transfers", 
+    func=lambda: sum_readings(burro.n_bytes_transferred for burro in list(BURROS))
+)
 
 class Transfer:
-    def __init__(self, rule_id, src_rse, dst_rse, priority, size_GB):
-        self.id = uuid.uuid4().hex
-        self.rule_id = rule_id
-        self.src_rse = src_rse
-        self.dst_rse = dst_rse
-        self.rse_pair_id = f"{src_rse}&{dst_rse}"
-        self.priority = priority
-        self.byte_count = size_GB*10**9
-        self.state = "PREPARING"
+    """
+    View of a single transfer of a Rule; only created when one is needed
+    """
+    __slots__ = ("rule", "index")
+
+    def __init__(self, rule, index):
+        self.rule = rule
+        self.index = index
+
+    @property
+    def id(self):
+        return self.rule.transfer_id(self.index)
+
+    @property
+    def rule_id(self):
+        return self.rule.rule_id
+
+    @property
+    def src_rse(self):
+        return self.rule.src_rse
+
+    @property
+    def dst_rse(self):
+        return self.rule.dst_rse
+
+    @property
+    def rse_pair_id(self):
+        return self.rule.rse_pair_id
+
+    @property
+    def priority(self):
+        return self.rule.priority
+
+    @property
+    def byte_count(self):
+        return self.rule.byte_count
+
+    @property
+    def state(self):
+        return STATES[self.rule.states[self.index]]
 
 class Rule:
+    """
+    Rule of n_transfers identical transfers, stored as columns rather than objects: the
+    attributes that every transfer shares are stored once, states are one-byte codes, 
+    and transfer IDs are generated on demand
+    """
     def __init__(self, rule_config):
-        self.transfers = []
-        self.rule_id = uuid.uuid4().hex
+        self.rule_id = rule_config.get("rule_id") or uuid.uuid4().hex
         self.delay = rule_config.get("delay")
-        for _ in range(rule_config.get("n_transfers")):
-            new_transfer = Transfer(
-                self.rule_id,
-                rule_config.get("src_rse"),
-                rule_config.get("dst_rse"),
-                rule_config.get("priority"),
-                rule_config.get("size_GB")/rule_config.get("n_transfers"),
-            )
-            self.transfers.append(new_transfer)
+        self.src_rse = sys.intern(rule_config.get("src_rse"))
+        self.dst_rse = sys.intern(rule_config.get("dst_rse"))
+        self.rse_pair_id = sys.intern(f"{self.src_rse}&{self.dst_rse}")
+        self.priority = rule_config.get("priority")
+        self.n_transfers = rule_config.get("n_transfers")
+        self.byte_count = rule_config.get("size_GB")/self.n_transfers*10**9
+        # State code of each transfer (all start as PREPARING)
+        self.states = array("b", bytes(self.n_transfers))
 
         src_limit = rule_config.get("src_limit", None)
         dst_limit = rule_config.get("dst_limit", None)
@@ -45,266 +109,843 @@ class Rule:
         else:
             self.transfer_limit = None
 
-    def get_transfers(self, state, throttler=False):
-        transfers = [transfer for transfer in self.transfers if transfer.state == state]
-        if self.transfer_limit and state == "WAITING":
-            n_active_transfers = len(self.get_transfers("SUBMITTED"))
-            return transfers[:(self.transfer_limit - n_active_transfers)]
+    def __len__(self):
+        return self.n_transfers
+
+    def __getitem__(self, index):
+        return Transfer(self, index)
+
+    def transfer_id(self, index):
+        return f"{self.rule_id[:24]}{index:08x}"
+
+class TransferBatch:
+    """
+    Transfers of a single rule, given as runs [start, stop) of transfer indices
+    """
+    __slots__ = ("rule", "runs")
+
+    def __init__(self, rule, runs):
+        self.rule = rule
+        self.runs = runs
+
+    def __len__(self):
+        return sum([stop - start for start, stop in self.runs])
+
+    def __iter__(self):
+        for start, stop in self.runs:
+            for index in range(start, stop):
+                yield Transfer(self.rule, index)
+
+    @property
+    def ids(self):
+        return [
+            self.rule.transfer_id(index) 
+            for start, stop in self.runs for index in range(start, stop)
+        ]
+
+    @property
+    def byte_count(self):
+        return len(self)*self.rule.byte_count
+
+    def head(self, n_transfers):
+        """
+        Returns a batch of the first n_transfers transfers of this batch
+        """
+        runs = []
+        for start, stop in self.runs:
+            if n_transfers <= 0:
+                break
+            runs.append((start, min(stop, start + n_transfers)))
+            n_transfers -= runs[-1][1] - start
+        return TransferBatch(self.rule, runs)
+
+class TransferStore:
+    """
+    Transfers indexed by state, then by rule ID, then by RSE pair ID; each bucket holds 
+    runs of transfer indices, so the transfers of a rule that move through the workflow
+    together cost a handful of runs rather than one entry each. The number of transfers 
+    in each state (per rule) is kept up to date, such that no daemon has to scan every 
+    transfer of every rule.
+    """
+    STATES = STATES
+
+    def __init__(self):
+        # buckets[state][rule ID][RSE pair ID] = runs [start, stop) of transfer indices
+        self.__buckets = {state: {} for state in self.STATES}
+        self.__counts = {state: 0 for state in self.STATES}
+        # rule_counts[(state, rule ID)] = number of transfers
+        self.__rule_counts = {}
+        self.__rules = {}
+        self.__lock = Lock()
+        # Set whenever transfers are moved into a state, to wake up the daemon that reads it
+        self.__arrivals = {state: Event() for state in self.STATES}
+
+    def __insert(self, state, rule, runs):
+        rule_buckets = self.__buckets[state].setdefault(rule.rule_id, {})
+        bucket = rule_buckets.setdefault(rule.rse_pair_id, [])
+        code = STATE_CODES[state]
+        n_transfers = 0
+        for start, stop in runs:
+            rule.states[start:stop] = array("b", [code])*(stop - start)
+            # Extend the last run if this one picks up where it ended
+            if len(bucket) > 0 and bucket[-1][1] == start:
+                bucket[-1] = (bucket[-1][0], stop)
+            else:
+                bucket.append((start, stop))
+            n_transfers += stop - start
+        self.__counts[state] += n_transfers
+        key = (state, rule.rule_id)
+        self.__rule_counts[key] = self.__rule_counts.get(key, 0) + n_transfers
+        self.__arrivals[state].set()
+
+    def __remove(self, state, rule, runs):
+        rule_buckets = self.__buckets[state][rule.rule_id]
+        bucket = rule_buckets[rule.rse_pair_id]
+        n_transfers = 0
+        for start, stop in runs:
+            # Cut [start, stop) out of every run that overlaps it
+            new_bucket = []
+            for run_start, run_stop in bucket:
+                if run_stop <= start or run_start >= stop:
+                    new_bucket.append((run_start, run_stop))
+                    continue
+                if run_start < start:
+                    new_bucket.append((run_start, start))
+                if run_stop > stop:
+                    new_bucket.append((stop, run_stop))
+                n_transfers += min(run_stop, stop) - max(run_start, start)
+            bucket = new_bucket
+        if len(bucket) > 0:
+            rule_buckets[rule.rse_pair_id] = bucket
         else:
-            return transfers
+            del rule_buckets[rule.rse_pair_id]
+            if len(rule_buckets) == 0:
+                del self.__buckets[state][rule.rule_id]
+        self.__counts[state] -= n_transfers
+        key = (state, rule.rule_id)
+        self.__rule_counts[key] -= n_transfers
+        if self.__rule_counts[key] == 0:
+            del self.__rule_counts[key]
 
-    def clean(self):
-        for transfer in self.get_transfers("DELETE"):
-            self.transfers.remove(transfer)
+    def add(self, rule):
+        """
+        Add every transfer of a new rule
+        """
+        with self.__lock:
+            self.__rules[rule.rule_id] = rule
+            self.__insert(STATES[0], rule, [(0, len(rule))])
+
+    def move(self, batch, state):
+        """
+        Move a batch of transfers (all in the same state) to a new state
+        """
+        if len(batch.runs) == 0:
+            return
+        with self.__lock:
+            old_state = STATES[batch.rule.states[batch.runs[0][0]]]
+            self.__remove(old_state, batch.rule, batch.runs)
+            self.__insert(state, batch.rule, batch.runs)
+
+    def clear(self, state):
+        """
+        Forget every transfer in the given state
+        """
+        with self.__lock:
+            for rule_id in self.__buckets[state]:
+                self.__rule_counts.pop((state, rule_id), None)
+            self.__buckets[state] = {}
+            self.__counts[state] = 0
+            # Forget rules that have no transfers left in any state
+            for rule_id in list(self.__rules):
+                if not any(rule_id in self.__buckets[s] for s in self.STATES):
+                    del self.__rules[rule_id]
+
+    def wait(self, state, timeout=None):
+        """
+        Wait until transfers are moved into the given state, or until the timeout has 
+        passed; returns whether any transfers arrived
+        """
+        arrived = self.__arrivals[state].wait(timeout)
+        self.__arrivals[state].clear()
+        return arrived
+
+    def wake(self, state=None):
+        """
+        Wake up everything that is waiting on the given state (default: on any state)
+        """
+        for arrival_state, arrival in self.__arrivals.items():
+            if state is None or arrival_state == state:
+                arrival.set()
+
+    def count(self, state=None, rule_id=None):
+        """
+        Returns the number of transfers in the given state (or in any state but DELETE), 
+        optionally only counting those of the given rule
+        """
+        if state is None:
+            return sum([
+                self.count(state=state, rule_id=rule_id) 
+                for state in self.STATES if state != "DELETE"
+            ])
+        elif rule_id is None:
+            return self.__counts[state]
+        else:
+            return self.__rule_counts.get((state, rule_id), 0)
+
+    def group(self, state):
+        """
+        Returns a snapshot of the transfers in the given state, grouped by rule ID and 
+        RSE pair ID: {rule ID: {RSE pair ID: TransferBatch}}
+        """
+        with self.__lock:
+            return {
+                rule_id: {
+                    rse_pair_id: TransferBatch(self.__rules[rule_id], list(runs))
+                    for rse_pair_id, runs in rule_buckets.items()
+                }
+                for rule_id, rule_buckets in self.__buckets[state].items()
+            }
+
+class DaemonTimings:
+    """
+    Wall-clock duration of each cycle of a daemon
+    """
+    def __init__(self):
+        self.n_cycles = 0
+        self.total = 0.
+        self.last = 0.
+        self.max = 0.
+
+    def record(self, elapsed):
+        self.n_cycles += 1
+        self.total += elapsed
+        self.last = elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def mean(self):
+        return self.total/self.n_cycles if self.n_cycles > 0 else 0.
+
+    def __repr__(self):
+        return (
+            f"{self.n_cycles} cycles, mean {1e3*self.mean:.3f} ms, "
+            f"last {1e3*self.last:.3f} ms, max {1e3*self.max:.3f} ms"
+        )
 
 class Burro:
-    def __init__(self, config_yaml, vsnet=True):
+    # Each daemon and the state of the transfers that it works on, in workflow order
+    DAEMONS = [
+        ("preparer", "PREPARING"), 
+        ("throttler", "WAITING"), 
+        ("submitter", "QUEUED"), 
+        ("poller", "SUBMITTED"), 
+        ("finisher", "DONE")
+    ]
+
+    def __init__(self, config_yaml, vsnet=True, dmm=True, simulate=False, rules=None, 
+                 clock=None):
         self.use_vsnet = vsnet
+        # Simulations run on their own clock, which the in-process VSNet shares
+        if simulate:
+            time_dilation = get_time_dilation() if clock is None else clock.time_dilation
+            self.simulation = Simulation(time_dilation=time_dilation)
+            clock = self.simulation
+        else:
+            self.simulation = None
+        # Virtual clock (a utils.vtime.Clock or Simulation; default: utils.vtime.now)
+        self.clock = clock
+        self.now = now if clock is None else clock.now
+        self.use_dmm = dmm and not simulate
         with open(config_yaml, "r") as config_yaml:
             config = yaml.safe_load(config_yaml)
             # Extract Burro configuration parameters
             burro_config = config.get("burro")
             self.heartbeat = burro_config.get("heartbeat", 10)
             self.use_throttler = burro_config.get("throttler", False)
-            all_rules = [Rule(rule_config) for rule_config in burro_config.get("rules")]
+            # Simulations are driven by heartbeats, so their daemons always run in sequence
+            self.pipelined = burro_config.get("pipelined", False) and not simulate
+            daemon_heartbeats = burro_config.get("daemon_heartbeats", {})
+            # Dump metrics every metrics_interval (real) seconds, to metrics_path or the log
+            self.metrics_interval = burro_config.get("metrics_interval", 0)
+            self.metrics_path = burro_config.get("metrics_path", None)
+            # Learn of finished connections from VSNet's event stream instead of polling
+            self.use_vsnet_events = (
+                burro_config.get("vsnet_events", False) and self.use_vsnet and not simulate
+            )
+            # Run the given rules (e.g. one shard of them) instead of those in the config
+            rule_configs = burro_config.get("rules") if rules is None else rules
+            all_rules = [Rule(rule_config) for rule_config in rule_configs]
             # Extract DMM configuration parameters
-            self.dmm_address = (os.environ["DMM_HOST"], int(os.environ["DMM_PORT"]))
-            with open(config.get("authkey"), "rb") as f_in:
-                self.dmm_authkey = f_in.read()
+            if self.use_dmm:
+                self.dmm_address = (os.environ["DMM_HOST"], int(os.environ["DMM_PORT"]))
+                with open(config.get("authkey"), "rb") as f_in:
+                    self.dmm_authkey = f_in.read()
+                self.dmm = DMMClient(
+                    self.dmm_address, 
+                    self.dmm_authkey, 
+                    persistent=burro_config.get("dmm_client", {}).get("persistent", False)
+                )
             # Extract VSNet configuration parameters
             vsnet_config = config.get("vsnet")
-            self.vsnet_url = f"{os.environ['VSNET_HOST']}:{os.environ['VSNET_PORT']}"
+            if simulate:
+                # Run VSNet in-process, driven by the simulation clock
+                from northbound.vsnet.service import VSNet
+                self.vsnet = VSNet(vsnet_config, clock=self.clock)
+            elif self.use_vsnet:
+                client_config = burro_config.get("vsnet_client", {})
+                self.vsnet = VSNetClient(
+                    f"{os.environ['VSNET_HOST']}:{os.environ['VSNET_PORT']}",
+                    max_workers=client_config.get("max_workers", 16),
+                    timeout=client_config.get("timeout", 10),
+                    retries=client_config.get("retries", 3),
+                    batch_size=client_config.get("batch_size", 100)
+                )
 
+        self.all_rules = all_rules
+        self.rules = {rule.rule_id: rule for rule in all_rules}
         self.active_rules = []
+        self.transfers = TransferStore()
         self.rule_stager = Thread(target=self.__stage_rules, args=(all_rules,))
         self.rule_stager.name = "StagerThread"
-        self.rule_runner = Thread(target=self.__run_rules)
-        self.rule_runner.name = "RunnerThread"
+        self.daemons = [
+            (name, state) for name, state in self.DAEMONS 
+            if name != "throttler" or self.use_throttler
+        ]
+        self.daemon_heartbeats = {
+            name: daemon_heartbeats.get(name, self.heartbeat) for name, _ in self.daemons
+        }
+        self.daemon_timings = {name: DaemonTimings() for name, _ in self.daemons}
+        if self.pipelined:
+            # One thread per daemon, each woken up by transfers arriving in its state
+            self.daemon_runners = [
+                Thread(target=self.__run_daemon, args=(name, state), name=f"{name.capitalize()}Thread")
+                for name, state in self.daemons
+            ]
+        else:
+            self.daemon_runners = [Thread(target=self.__run_rules, name="RunnerThread")]
         self.lock = Lock()
         self.__stop_event = Event()
         self.__heart = Event()
+        self.__n_heartbeats = 0
+        self.n_transfers_finished = 0
+        self.n_bytes_transferred = 0.
+        self.__started_connections = set()
+        self.__finished_connections = set()
+        self.__connections_lock = Lock()
+        self.event_listener = Thread(target=self.__listen, name="EventThread")
+        self.metrics_dumper = Thread(target=self.__dump_metrics_periodically, name="MetricsThread")
+        BURROS.add(self)
 
     def start(self):
         self.rule_stager.start()
-        self.rule_runner.start()
+        if self.use_vsnet_events:
+            self.event_listener.start()
+        for runner in self.daemon_runners:
+            runner.start()
+        if self.metrics_interval > 0:
+            self.metrics_dumper.start()
 
     def stop(self):
         self.__stop_event.set()
         self.__heart.set()
+        self.transfers.wake()
         self.rule_stager.join()
-        self.rule_runner.join()
+        for runner in self.daemon_runners:
+            runner.join()
+        if self.use_vsnet_events:
+            self.event_listener.join()
+        if self.metrics_dumper.is_alive():
+            self.metrics_dumper.join()
+        if self.use_dmm:
+            self.dmm.close()
+        for name, timings in self.daemon_timings.items():
+            logging.info(f"{name}: {timings}")
+        if self.metrics_interval > 0 or self.metrics_path:
+            self.dump_metrics()
+
+    def metrics(self):
+        return {
+            "n_rules": len(self.all_rules),
+            "n_rules_active": len(self.active_rules),
+            "n_transfers_pending": self.transfers.count(),
+            "n_transfers_finished": self.n_transfers_finished,
+            "n_bytes_transferred": self.n_bytes_transferred,
+            "daemons": {
+                name: {"n_cycles": timings.n_cycles, "total": timings.total, "max": timings.max}
+                for name, timings in self.daemon_timings.items()
+            }
+        }
+
+    def is_alive(self):
+        return any([runner.is_alive() for runner in self.daemon_runners])
+
+    def dump_metrics(self):
+        """
+        Write every metric of this process to metrics_path (suffixed with the name of 
+        the worker process, if any) in the Prometheus text format, or log them
+        """
+        if self.metrics_path:
+            process_name = current_process().name
+            if process_name == "MainProcess":
+                REGISTRY.dump(self.metrics_path)
+            else:
+                REGISTRY.dump(f"{self.metrics_path}.{process_name}")
+        else:
+            for line in REGISTRY.summary():
+                logging.info(line)
+
+    def __dump_metrics_periodically(self):
+        while not self.__stop_event.wait(self.metrics_interval):
+            self.dump_metrics()
+
+    @property
+    def time_dilation(self):
+        return get_time_dilation() if self.clock is None else self.clock.time_dilation
 
     def __stage_rules(self, rules):
+        """
+        Release each rule once its delay (in virtual seconds) has passed, sleeping until 
+        the next release (or until stop() is called) in between
+        """
         logging.debug(f"Starting rule stager; {len(rules)} rules to stage")
-        t_start = now()
-        remaining_rules = list(rules) # make a local copy
+        t_start = self.now()
+        remaining_rules = sorted(rules, key=lambda rule: rule.delay)
         while not self.__stop_event.is_set() and len(remaining_rules) > 0:
-            t_now = now()
-            rules_to_start = []
-            for rule in remaining_rules:
-                if (t_now - t_start) > rule.delay:
-                    rules_to_start.append(rule)
+            wait_time = (t_start + remaining_rules[0].delay - self.now())/self.time_dilation
+            if wait_time > 0:
+                self.__stop_event.wait(wait_time)
+                continue
+            # Release every rule that is due
+            t_elapsed = self.now() - t_start
+            n_released = 0
+            while n_released < len(remaining_rules) and remaining_rules[n_released].delay <= t_elapsed:
+                n_released += 1
             self.lock.acquire()
-            for rule in rules_to_start:
-                self.active_rules.append(rule)
-                remaining_rules.remove(rule)
+            for rule in remaining_rules[:n_released]:
+                self.__release_rule(rule)
             self.lock.release()
+            remaining_rules = remaining_rules[n_released:]
+            # Wake up the rule runner rather than waiting for the next heartbeat
+            self.__heart.set()
         logging.debug(f"Stopping rule stager; no more rules to stage")
 
     def __run_rules(self):
-        n_heartbeats = 0
+        while True:
+            self.__heart.clear()
+            if self.__stop_event.is_set():
+                break
+            self.__beat()
+            self.__heart.wait(self.heartbeat)
+
+    def __run_daemon(self, name, state):
+        """
+        Run a single daemon on the transfers in its state whenever new ones arrive, or 
+        at least every daemon_heartbeats[name] seconds, independently of the others
+        """
+        logging.debug(f"Starting {name}")
         while not self.__stop_event.is_set():
-            logging.debug(f"Starting heartbeat {n_heartbeats}")
-            self.lock.acquire()
-            for rule in self.active_rules:
-                rule.clean()
-            active_rules = list(self.active_rules)
-            self.lock.release()
-            # Collect transfers
-            transfers = {
-                "PREPARING": [],
-                "WAITING": [],
-                "QUEUED": [],
-                "SUBMITTED": [],
-                "DONE": []
-            }
-            for rule in active_rules:
-                for state in transfers.keys():
-                    transfers[state] += rule.get_transfers(
-                        state, 
-                        throttler=self.use_throttler
+            if name == "finisher":
+                self.transfers.clear("DELETE")
+            transfers = self.transfers.group(state)
+            if name == "throttler":
+                transfers = self.__throttle(transfers)
+            self.__run_daemon_cycle(name, transfers)
+            self.transfers.wait(state, self.daemon_heartbeats[name])
+        logging.debug(f"Stopping {name}")
+
+    def __run_daemon_cycle(self, name, transfers):
+        t_start = time.perf_counter()
+        getattr(self, name)(transfers)
+        self.daemon_timings[name].record(time.perf_counter() - t_start)
+
+    def __listen(self):
+        """
+        Follow VSNet's stream of connection events, waking up the poller as soon as one 
+        of the connections that Burro started finishes
+        """
+        logging.debug("Starting VSNet event listener")
+        last_seq = 0
+        while not self.__stop_event.is_set():
+            finished_connections = set()
+            try:
+                reply = self.vsnet.events(after=last_seq, timeout=self.heartbeat)
+                if reply["missed"]:
+                    # Events were dropped before they could be read, so check instead
+                    with self.__connections_lock:
+                        connection_ids = list(self.__started_connections - self.__finished_connections)
+                    logging.warning(f"Missed VSNet events; checking {len(connection_ids)} connections")
+                    for connection_id, connection_data in zip(connection_ids, self.vsnet.check_connections(connection_ids)):
+                        if is_connection_over(connection_id, connection_data):
+                            finished_connections.add(connection_id)
+            except (requests.RequestException, ValueError) as error:
+                # last_seq is left as is, so missed events are checked again next time
+                logging.warning(f"Failed to get VSNet events ({error}); retrying")
+                self.__stop_event.wait(self.heartbeat)
+                continue
+            last_seq = reply["last_seq"]
+            for event in reply["events"]:
+                if event["type"] == "finished":
+                    finished_connections.add(event["connection_id"])
+                else:
+                    logging.debug(
+                        f"{event['connection_id']} now at {event['bandwidth']} B/s; "
+                        f"projected to end at {event['projected_end_time']}"
                     )
-            # Process transfers
-            self.preparer(transfers["PREPARING"])
-            if self.use_throttler:
-                self.throttler(transfers["WAITING"])
-            self.submitter(transfers["QUEUED"])
-            self.poller(transfers["SUBMITTED"])
-            self.finisher(transfers["DONE"])
-            self.__heart.wait(self.heartbeat)
-            n_heartbeats += 1
+            with self.__connections_lock:
+                finished_connections &= self.__started_connections
+                self.__finished_connections |= finished_connections
+            if len(finished_connections) > 0:
+                if self.pipelined:
+                    self.transfers.wake("SUBMITTED")
+                else:
+                    self.__heart.set()
+        logging.debug("Stopping VSNet event listener")
+
+    def __beat(self):
+        logging.debug(f"Starting heartbeat {self.__n_heartbeats}")
+        self.transfers.clear("DELETE")
+        # Collect transfers (grouped by rule ID, then RSE pair ID)
+        transfers = {
+            state: self.transfers.group(state) 
+            for state in ["PREPARING", "WAITING", "QUEUED", "SUBMITTED", "DONE"]
+        }
+        # Process transfers
+        for name, state in self.daemons:
+            if name == "throttler":
+                self.__run_daemon_cycle(name, self.__throttle(transfers[state]))
+            else:
+                self.__run_daemon_cycle(name, transfers[state])
+        self.__n_heartbeats += 1
+
+    def __throttle(self, waiting_transfers):
+        """
+        Returns only the waiting transfers that fit within their rule's transfer limit
+        """
+        throttled_transfers = {}
+        for rule_id, rule_transfers in waiting_transfers.items():
+            transfer_limit = self.rules[rule_id].transfer_limit
+            if not transfer_limit:
+                throttled_transfers[rule_id] = rule_transfers
+                continue
+            n_in_flight = self.transfers.count("SUBMITTED", rule_id)
+            if self.pipelined:
+                # The throttler can run several times before the submitter catches up,
+                # so queued transfers count against the limit too
+                n_in_flight += self.transfers.count("QUEUED", rule_id)
+            n_free = max(transfer_limit - n_in_flight, 0)
+            throttled_transfers[rule_id] = {}
+            for rse_pair_id, transfers in rule_transfers.items():
+                if n_free == 0:
+                    break
+                throttled_transfers[rule_id][rse_pair_id] = transfers.head(n_free)
+                n_free -= len(throttled_transfers[rule_id][rse_pair_id])
+
+        return throttled_transfers
+
+    def simulate(self):
+        """
+        Run every rule to completion as a discrete-event simulation: rule releases, 
+        heartbeats, and VSNet connection completions are events, and the virtual clock 
+        jumps from one to the next, so the run takes only as long as the CPU needs
+        """
+        simulation = self.simulation
+        use_simulation(simulation)
+        self.__next_end = None
+        logging.debug(f"Starting simulation; {len(self.all_rules)} rules to stage")
+        for rule in self.all_rules:
+            simulation.schedule(rule.delay, self.__release_rule, rule)
+        simulation.schedule(0., self.__simulate_beat, simulation)
+        simulation.run()
+        logging.info(
+            f"Finished simulation at t = {simulation.time} virtual seconds "
+            f"({simulation.n_events} events, {self.__n_heartbeats} heartbeats)"
+        )
+        for name, timings in self.daemon_timings.items():
+            logging.info(f"{name}: {timings}")
+        if self.metrics_interval > 0 or self.metrics_path:
+            self.dump_metrics()
+        return simulation
+
+    def __release_rule(self, rule):
+        self.active_rules.append(rule)
+        self.transfers.add(rule)
+
+    def __simulate_beat(self, simulation):
+        self.__beat()
+        if self.use_vsnet:
+            self.__schedule_connection_ends(simulation)
+        # Keep beating until every rule is staged and finished
+        if len(self.active_rules) < len(self.all_rules) or self.transfers.count() > 0:
+            simulation.schedule_in(
+                self.heartbeat*simulation.time_dilation, 
+                self.__simulate_beat, 
+                simulation
+            )
+
+    def __schedule_connection_ends(self, simulation):
+        """
+        Schedule a completion event at the earliest projected end time of the VSNet 
+        connections, replacing the pending one if that end time has moved
+        """
+        end_time = self.vsnet.next_end_time()
+        if self.__next_end is not None:
+            if self.__next_end[0] == end_time:
+                return
+            simulation.cancel(self.__next_end[1])
+            self.__next_end = None
+        if end_time is not None:
+            handle = simulation.schedule(
+                max(end_time, simulation.time), 
+                self.__end_connections, 
+                simulation
+            )
+            self.__next_end = (end_time, handle)
+
+    def __end_connections(self, simulation):
+        # Finalizing connections frees bandwidth, which can move other end times
+        self.__next_end = None
+        self.vsnet.finalize(simulation.time)
+        self.__schedule_connection_ends(simulation)
 
     @time_this
     def preparer(self, transfers):
-        logging.debug(f"Running preparer on {len(transfers)} transfers")
+        logging.debug(f"Running preparer on {count_transfers(transfers)} transfers")
         prepared_rules = {}
-        for transfer in transfers:
-            # Check if rule has been accounted for
-            rule_id = transfer.rule_id
-            if rule_id not in prepared_rules.keys():
-                prepared_rules[rule_id] = {}
-            # Check if RSE pair has been accounted for
-            rse_pair_id = transfer.rse_pair_id
-            if rse_pair_id not in prepared_rules[rule_id].keys():
+        for rule_id, rule_transfers in transfers.items():
+            prepared_rules[rule_id] = {}
+            for rse_pair_id, pair_transfers in rule_transfers.items():
                 prepared_rules[rule_id][rse_pair_id] = {
-                    "transfer_ids": [],
-                    "priority": transfer.priority,
-                    "n_transfers_total": 0,
-                    "n_bytes_total": 0
+                    "transfer_ids": pair_transfers.ids,
+                    "priority": pair_transfers.rule.priority,
+                    "n_transfers_total": len(pair_transfers),
+                    "n_bytes_total": pair_transfers.byte_count
                 }
-            # Update request attributes
-            prepared_rules[rule_id][rse_pair_id]["transfer_ids"].append(transfer.id)
-            prepared_rules[rule_id][rse_pair_id]["n_transfers_total"] += 1
-            prepared_rules[rule_id][rse_pair_id]["n_bytes_total"] += transfer.byte_count
-            if self.use_throttler:
-                transfer.state = "WAITING"
-            else:
-                transfer.state = "QUEUED"
 
         # Send prepared rules to DMM
-        with Client(self.dmm_address, authkey=self.dmm_authkey) as client:
-            client.send(("PREPARER", prepared_rules))
-
-        if not self.use_vsnet:
-            return
+        if self.use_dmm:
+            self.dmm.send(("PREPARER", prepared_rules))
 
         # Send prepared rules to VSNet
-        for rule_id, rule_data in prepared_rules.items():
-            for rse_pair_id, transfer_data in rule_data.items():
-                src, dst = rse_pair_id.split("&")
-                requests.post(
-                    f"http://{self.vsnet_url}/connections", 
-                    params={
+        if self.use_vsnet:
+            new_connections = []
+            besteff_connections = []
+            for rule_id, rule_data in prepared_rules.items():
+                for rse_pair_id, transfer_data in rule_data.items():
+                    src, dst = rse_pair_id.split("&")
+                    new_connections.append({
                         "burro_id": rule_id, 
                         "src": src, 
                         "dst": dst, 
                         "total_data": transfer_data["n_bytes_total"]
-                    }
-                )
-                if transfer_data["priority"] == 0:
-                    route_info = requests.get(
-                        f"http://{self.vsnet_url}/routes",
-                        params={"src": src, "dst": dst} # FIXME: NONSENSE has to look up src, dst VSNet names... maybe change how API works?
-                    ).json()
-
-                    connection_id = f"{rule_id}_{src}_{dst}"
-                    requests.put(
-                        f"http://{self.vsnet_url}/connections/{connection_id}/update", 
-                        params={"bandwidth": 0., "route_id": route_info["route_id"]}
-                    )
+                    })
+                    # Without DMM, nothing provisions priority bandwidth, so use best effort
+                    if transfer_data["priority"] == 0 or not self.use_dmm:
+                        besteff_connections.append((f"{rule_id}_{src}_{dst}", src, dst))
+            self.vsnet.create_connections(new_connections)
+
+            # FIXME: NONSENSE has to look up src, dst VSNet names... maybe change how API works?
+            route_infos = self.vsnet.get_routes([
+                {"src": src, "dst": dst} for _, src, dst in besteff_connections
+            ])
+            self.vsnet.update_connections([
+                {"connection_id": connection_id, "bandwidth": 0., "route_id": route_info["route_id"]}
+                for (connection_id, _, _), route_info in zip(besteff_connections, route_infos)
+                if route_info["ok"]
+            ])
+
+        # Only hand the transfers over once their connections exist, since the next 
+        # daemons may already be waiting for them (see pipelined mode)
+        for rule_transfers in transfers.values():
+            for pair_transfers in rule_transfers.values():
+                if self.use_throttler:
+                    self.transfers.move(pair_transfers, "WAITING")
+                else:
+                    self.transfers.move(pair_transfers, "QUEUED")
 
     @time_this
     def throttler(self, transfers):
-        logging.debug(f"Running throttler on {len(transfers)} transfers")
-        for transfer in transfers:
-            transfer.state = "QUEUED"
+        logging.debug(f"Running throttler on {count_transfers(transfers)} transfers")
+        for rule_transfers in transfers.values():
+            for pair_transfers in rule_transfers.values():
+                self.transfers.move(pair_transfers, "QUEUED")
 
     @time_this
     def submitter(self, transfers):
-        logging.debug(f"Running submitter on {len(transfers)} transfers")
-        # Count submissions and sort by rule id and RSE pair
-        connection_ids = set()
+        logging.debug(f"Running submitter on {count_transfers(transfers)} transfers")
+        # Count submissions by rule id and RSE pair
+        connection_ids = []
         submitter_reports = {}
-        for transfer in transfers:
-            # Get rule ID
-            rule_id = transfer.rule_id
-            if rule_id not in submitter_reports.keys():
-                submitter_reports[rule_id] = {}
-            # Get RSE pair ID
-            rse_pair_id = transfer.rse_pair_id
-            if rse_pair_id not in submitter_reports[rule_id].keys():
+        for rule_id, rule_transfers in transfers.items():
+            submitter_reports[rule_id] = {}
+            for rse_pair_id, pair_transfers in rule_transfers.items():
                 submitter_reports[rule_id][rse_pair_id] = {
-                    "priority": transfer.priority, # attach priority in case it changed
-                    "n_transfers_submitted": 0
+                    "priority": pair_transfers.rule.priority, # attach priority in case it changed
+                    "n_transfers_submitted": len(pair_transfers)
                 }
-
-            submitter_reports[rule_id][rse_pair_id]["n_transfers_submitted"] += 1
-            connection_ids.add(f"{rule_id}_{transfer.src_rse}_{transfer.dst_rse}")
-            transfer.state = "SUBMITTED"
+                src, dst = rse_pair_id.split("&")
+                connection_ids.append(f"{rule_id}_{src}_{dst}")
+                self.transfers.move(pair_transfers, "SUBMITTED")
 
         # Get SENSE mapping
-        with Client(self.dmm_address, authkey=self.dmm_authkey) as client:
-            client.send(("SUBMITTER", submitter_reports))
-            sense_map = client.recv()
+        if self.use_dmm:
+            sense_map = self.dmm.request(("SUBMITTER", submitter_reports))
             logging.info(sense_map)
 
         if not self.use_vsnet:
             return
 
         # Start VSNet data transfers
-        for connection_id in connection_ids:
-            requests.put(
-                f"http://{self.vsnet_url}/connections/{connection_id}/start"
-            )
+        with self.__connections_lock:
+            self.__started_connections.update(connection_ids)
+        self.vsnet.start_connections(connection_ids)
 
     @time_this
-    def poller(self, unsorted_transfers):
-        logging.debug(f"Running poller on {len(unsorted_transfers)} transfers")
-        if not self.use_vsnet:
-            for transfer in unsorted_transfers:
-                transfer.state = "DONE"
-            return
-
+    def poller(self, transfers):
+        logging.debug(f"Running poller on {count_transfers(transfers)} transfers")
         # Sort transfers by VSNet Connection ID
         sorted_transfers = {}
-        for transfer in unsorted_transfers:
-            connection_id = f"{transfer.rule_id}_{transfer.src_rse}_{transfer.dst_rse}"
-            if connection_id not in sorted_transfers.keys():
-                sorted_transfers[connection_id] = []
+        for rule_id, rule_transfers in transfers.items():
+            for rse_pair_id, pair_transfers in rule_transfers.items():
+                src, dst = rse_pair_id.split("&")
+                sorted_transfers[f"{rule_id}_{src}_{dst}"] = pair_transfers
 
-            sorted_transfers[connection_id].append(transfer)
+        if not self.use_vsnet:
+            for pair_transfers in sorted_transfers.values():
+                self.transfers.move(pair_transfers, "DONE")
+            return
+
+        if self.use_vsnet_events:
+            # Finished connections were already pushed by VSNet (see __listen)
+            with self.__connections_lock:
+                finished_connections = self.__finished_connections & sorted_transfers.keys()
+            for connection_id in finished_connections:
+                self.transfers.move(sorted_transfers[connection_id], "DONE")
+                self.__forget_connection(connection_id, sorted_transfers[connection_id].rule)
+            return
 
         # Parse sorted transfers
-        for connection_id, transfers in sorted_transfers.items():
-            connection_data = requests.get(
-                f"http://{self.vsnet_url}/connections/{connection_id}/check"
-            ).json()
-            if connection_data.get("is_finished", False):
-                for transfer in transfers:
-                    transfer.state = "DONE"
+        try:
+            all_connection_data = self.vsnet.check_connections(list(sorted_transfers.keys()))
+        except (requests.RequestException, ValueError) as error:
+            # The transfers stay SUBMITTED, so they are checked again on the next cycle
+            logging.warning(f"Failed to check VSNet connections ({error})")
+            return
+        for (connection_id, pair_transfers), connection_data in zip(sorted_transfers.items(), all_connection_data):
+            if is_connection_over(connection_id, connection_data):
+                self.transfers.move(pair_transfers, "DONE")
+                self.__forget_connection(connection_id, pair_transfers.rule)
             else:
                 remaining_time = connection_data.get("remaining_time", None)
                 logging.debug(
                     f"{connection_id} not yet finished; {remaining_time} left"
                 )
 
-    @time_this
-    def finisher(self, unsorted_transfers):
-        logging.debug(f"Running finisher on {len(unsorted_transfers)} transfers")
-        # Sort transfers by rule ID and stage them for deletion
-        sorted_transfers = {}
-        for transfer in unsorted_transfers:
-            rule_id = transfer.rule_id
-            if rule_id not in sorted_transfers.keys():
-                sorted_transfers[rule_id] = []
-            sorted_transfers[rule_id].append(transfer)
-            transfer.state = "DELETE"
+    def __forget_connection(self, connection_id, rule):
+        """
+        Stop tracking a finished connection once no transfer of its rule can still be
+        submitted to it (every rule has a single RSE pair, hence a single connection)
+        """
+        if any(self.transfers.count(state, rule.rule_id) > 0 for state in STATES[:4]):
+            return
+        with self.__connections_lock:
+            self.__started_connections.discard(connection_id)
+            self.__finished_connections.discard(connection_id)
 
-        # Parse sorted transfers
-        for rule_id, transfers in sorted_transfers.items():
+    @time_this
+    def finisher(self, transfers):
+        logging.debug(f"Running finisher on {count_transfers(transfers)} transfers")
+        # Count finished transfers by rule ID and RSE pair and stage them for deletion
+        all_finisher_reports = {}
+        for rule_id, rule_transfers in transfers.items():
             finisher_reports = {}
-            for transfer in transfers:
-                rse_pair_id = transfer.rse_pair_id
-                if rse_pair_id not in finisher_reports.keys():
-                    finisher_reports[rse_pair_id] = {
-                        "n_transfers_finished": 0,
-                        "n_bytes_transferred": 0
-                    }
-                finisher_reports[rse_pair_id]["n_transfers_finished"] += 1
-                finisher_reports[rse_pair_id]["n_bytes_transferred"] += transfer.byte_count
-
-            with Client(self.dmm_address, authkey=self.dmm_authkey) as client:
-                client.send(("FINISHER", {rule_id: finisher_reports}))
+            for rse_pair_id, pair_transfers in rule_transfers.items():
+                finisher_reports[rse_pair_id] = {
+                    "n_transfers_finished": len(pair_transfers),
+                    "n_bytes_transferred": pair_transfers.byte_count
+                }
+                self.transfers.move(pair_transfers, "DELETE")
+                self.n_transfers_finished += len(pair_transfers)
+                self.n_bytes_transferred += pair_transfers.byte_count
+            all_finisher_reports[rule_id] = finisher_reports
+
+        # Send the reports for every rule to DMM in one message
+        if self.use_dmm and len(all_finisher_reports) > 0:
+            self.dmm.send(("FINISHER", all_finisher_reports))
+
+def count_transfers(transfers):
+    """
+    Returns the number of transfers in {rule ID: {RSE pair ID: TransferBatch}}
+    """
+    return sum([
+        len(pair_transfers) 
+        for rule_transfers in transfers.values() 
+        for pair_transfers in rule_transfers.values()
+    ])
+
+def is_connection_over(connection_id, connection_data):
+    """
+    Returns whether a connection that Burro started has finished, given its result 
+    from VSNet's check_connections; a connection that VSNet no longer knows about 
+    (its summary was forgotten, or VSNet restarted) is taken as finished, since 
+    otherwise its transfers would never leave SUBMITTED
+    """
+    if connection_data.get("ok", True):
+        return connection_data.get("is_finished", False)
+    logging.warning(
+        f"VSNet does not know {connection_id} ({connection_data.get('detail')}); "
+        "taking it as finished"
+    )
+    return True
+
+def shard_rules(rule_configs, n_shards):
+    """
+    Give every rule a rule ID (if it does not have one already) and split the rules 
+    into n_shards lists by a hash of their rule ID that is stable across processes
+    """
+    shards = [[] for _ in range(n_shards)]
+    for rule_config in rule_configs:
+        rule_config = {**rule_config, "rule_id": rule_config.get("rule_id") or uuid.uuid4().hex}
+        shards[zlib.crc32(rule_config["rule_id"].encode()) % n_shards].append(rule_config)
+    return shards
+
+def run_worker(config_yaml, rules, stop_event, metrics_queue, vsnet=True, dmm=True):
+    """
+    Run one Burro on the given shard of rules in a worker process until stop_event is 
+    set, reporting Burro.metrics() to the parent every heartbeat (and once stopped)
+    """
+    # Leave SIGINT to the parent, which stops every worker through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    burro = Burro(config_yaml, vsnet=vsnet, dmm=dmm, rules=rules)
+    worker_name = current_process().name
+    logging.info(f"Starting Burro on {len(rules)} rules")
+    burro.start()
+    while not stop_event.wait(burro.heartbeat):
+        metrics_queue.put((worker_name, burro.metrics()))
+    burro.stop()
+    if burro.use_vsnet:
+        burro.vsnet.close()
+    metrics_queue.put((worker_name, burro.metrics()))
+    logging.info("Stopped Burro")
+
+def aggregate_metrics(all_metrics):
+    """
+    Combine the latest Burro.metrics() of every worker
+    """
+    total = {
+        key: sum([metrics[key] for metrics in all_metrics]) 
+        for key in ["n_rules", "n_rules_active", "n_transfers_pending", 
+                    "n_transfers_finished", "n_bytes_transferred"]
+    }
+    total["daemons"] = {}
+    for metrics in all_metrics:
+        for name, timings in metrics["daemons"].items():
+            daemon_total = total["daemons"].setdefault(
+                name, {"n_cycles": 0, "total": 0., "max": 0.}
+            )
+            daemon_total["n_cycles"] += timings["n_cycles"]
+            daemon_total["total"] += timings["total"]
+            daemon_total["max"] = max(daemon_total["max"], timings["max"])
+    return total
 
 def sigint_handler(burro):
     def actual_handler(sig, frame):
@@ -0,0 +1,80 @@
+import logging
+from threading import Lock
+from multiprocessing.connection import Client
+
+from utils.metrics import REGISTRY
+
+DMM_MESSAGES = REGISTRY.counter(
+    "dmm_messages_total", "Messages exchanged with DMM", labelnames=("direction",)
+)
+DMM_CONNECTS = REGISTRY.counter("dmm_connects_total", "Connections opened to DMM")
+
+class DMMClient:
+    """
+    Connection to DMM; by default, a fresh connection is used for every call. With 
+    persistent=True, one connection is opened lazily and re-opened whenever DMM has 
+    closed it, such that the TCP connect and authkey handshake are paid once rather 
+    than once per message; this is only safe with a DMM that keeps connections open, 
+    since a message sent (without waiting for a reply) just as DMM hangs up is lost.
+    A call is retried once, and only if DMM cannot have received any of its messages.
+    """
+    def __init__(self, address, authkey, persistent=False):
+        self.address = address
+        self.authkey = authkey
+        self.persistent = persistent
+        self.n_connects = 0
+        self.__connection = None
+        self.__lock = Lock()
+
+    def __connect(self):
+        if self.__connection and self.__connection.poll():
+            # Nothing is expected from DMM between requests, so a readable connection
+            # means that DMM has closed it (or that it is out of sync): start over
+            logging.debug("DMM connection is stale; reconnecting")
+            self.close()
+        if not self.__connection:
+            self.__connection = Client(self.address, authkey=self.authkey)
+            self.n_connects += 1
+            DMM_CONNECTS.inc()
+        return self.__connection
+
+    def __call(self, messages, n_replies):
+        with self.__lock:
+            for attempt in range(2):
+                previous_connection = self.__connection
+                connection = None
+                n_sent = 0
+                try:
+                    connection = self.__connect()
+                    for message in messages:
+                        connection.send(message)
+                        n_sent += 1
+                        DMM_MESSAGES.inc(direction="sent")
+                    replies = [connection.recv() for _ in range(n_replies)]
+                    DMM_MESSAGES.inc(n_replies, direction="received")
+                    if not self.persistent:
+                        self.close()
+                    return replies
+                except (EOFError, OSError) as error:
+                    self.close()
+                    # Only start over if DMM cannot have seen any message yet: either 
+                    # connecting failed, or a reused connection broke on the first send; 
+                    # otherwise DMM may already have acted on the messages
+                    is_unsent = connection is None or (connection is previous_connection and n_sent == 0)
+                    if attempt > 0 or not is_unsent:
+                        raise
+                    logging.debug(f"Lost DMM connection ({error}); reconnecting")
+
+    def close(self):
+        if self.__connection:
+            try:
+                self.__connection.close()
+            except OSError:
+                pass
+            self.__connection = None
+
+    def send(self, message):
+        self.__call([message], 0)
+
+    def request(self, message):
+        return self.__call([message], 1)[0]
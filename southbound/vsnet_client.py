@@ -0,0 +1,136 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import REGISTRY
+
+VSNET_REQUESTS = REGISTRY.counter(
+    "http_client_requests_total", "HTTP requests sent", labelnames=("target", "method", "status")
+)
+
+def count_vsnet_request(response, *args, **kwargs):
+    VSNET_REQUESTS.inc(target="vsnet", method=response.request.method, status=response.status_code)
+
+class VSNetClient:
+    """
+    Client for the VSNet API; mirrors the interface of northbound.vsnet.service.VSNet
+    so that Burro can talk to VSNet over HTTP or in-process. Requests share a pool of
+    keep-alive connections, are retried on connection errors (and GETs also on read
+    errors and 5xx responses, since creating, updating or starting a connection twice
+    is not harmless), and can be issued concurrently with map(); batch calls are split 
+    into chunks of at most batch_size items that are sent concurrently. Error responses 
+    raise requests.HTTPError rather than being returned as results.
+    """
+    def __init__(self, vsnet_url, max_workers=16, timeout=10, retries=3, batch_size=100):
+        self.vsnet_url = vsnet_url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.1,
+                status_forcelist=[500, 502, 503, 504],
+                # Requests that never reached VSNet (connect errors) are retried for
+                # every method; the others only for GETs, which change nothing
+                allowed_methods=frozenset(["GET"])
+            )
+        )
+        self.session.mount("http://", adapter)
+        self.session.hooks["response"].append(count_vsnet_request)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="VSNetClient"
+        )
+
+    def map(self, func, items):
+        """
+        Call func on every item concurrently; returns the results in order
+        """
+        return list(self.executor.map(func, items))
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def __request(self, method, path, timeout=None, **kwargs):
+        """
+        Send a request to VSNet; raises requests.HTTPError for 4xx and 5xx responses
+        """
+        response = self.session.request(
+            method, 
+            f"http://{self.vsnet_url}{path}", 
+            timeout=self.timeout if timeout is None else timeout, 
+            **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def get_route(self, src, dst):
+        return self.__request("GET", "/routes", params={"src": src, "dst": dst}).json()
+
+    def events(self, after=0, timeout=0.):
+        return self.__request(
+            "GET", "/events",
+            params={"after": after, "timeout": timeout},
+            timeout=self.timeout + timeout
+        ).json()
+
+    def check_connection(self, connection_id):
+        return self.__request("GET", f"/connections/{connection_id}/check").json()
+
+    def create_connection(self, burro_id, src, dst, total_data):
+        self.__request(
+            "POST", "/connections",
+            params={
+                "burro_id": burro_id,
+                "src": src,
+                "dst": dst,
+                "total_data": total_data
+            }
+        )
+
+    def update_connection(self, connection_id, bandwidth, route_id):
+        self.__request(
+            "PUT", f"/connections/{connection_id}/update",
+            params={"bandwidth": bandwidth, "route_id": route_id}
+        )
+
+    def start_connection(self, connection_id):
+        self.__request("PUT", f"/connections/{connection_id}/start")
+
+    def __send_chunk(self, method, path, chunk):
+        results = self.__request(method, path, json=chunk).json()
+        if not isinstance(results, list) or len(results) != len(chunk):
+            raise ValueError(
+                f"{method} {path} returned {len(results)} results for {len(chunk)} items"
+                if isinstance(results, list) else f"{method} {path} did not return a list"
+            )
+        return results
+
+    def __batch(self, method, path, items):
+        items = list(items)
+        chunks = [
+            items[chunk_i:chunk_i + self.batch_size] 
+            for chunk_i in range(0, len(items), self.batch_size)
+        ]
+        results = self.map(lambda chunk: self.__send_chunk(method, path, chunk), chunks)
+        return [result for chunk_results in results for result in chunk_results]
+
+    def get_routes(self, site_pairs):
+        return self.__batch("POST", "/routes/batch", site_pairs)
+
+    def check_connections(self, connection_ids):
+        return self.__batch("POST", "/connections/batch/check", connection_ids)
+
+    def create_connections(self, new_connections):
+        return self.__batch("POST", "/connections/batch", new_connections)
+
+    def update_connections(self, updates):
+        return self.__batch("PUT", "/connections/batch/update", updates)
+
+    def start_connections(self, connection_ids):
+        return self.__batch("PUT", "/connections/batch/start", connection_ids)
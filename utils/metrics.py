@@ -0,0 +1,334 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import functools
+from bisect import bisect_left
+from collections import Counter as StackCounter
+
+# Upper bounds (in real seconds) of the buckets of timing histograms
+DEFAULT_BUCKETS = (
+    1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1., 5., 10.
+)
+
+def format_labels(labelnames, labelvalues, extra=()):
+    labels = list(zip(labelnames, labelvalues)) + list(extra)
+    if not labels:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels
+    ]
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in escaped) + "}"
+
+class Metric:
+    """
+    Named metric with one value (or set of values) per combination of label values
+    """
+    TYPE = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """
+        Returns (suffix, label values, extra labels, value) for every sample
+        """
+        with self._lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, key, extra, value in self.samples():
+            labels = format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}{suffix}{labels} {float(value)!r}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    Gauge that is either set explicitly or, if func is given, read when it is
+    collected; func returns a number, or a dict of label values (tuples) to numbers
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), func=None):
+        super().__init__(name, help_text, labelnames=labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", key, (), value) for key, value in values.items()]
+
+def sum_readings(readings):
+    """
+    Adds up gauge readings, each a number or a dict of label values (tuples) to 
+    numbers, into one reading (e.g. to report on every instance of a class at once)
+    """
+    totals = {}
+    for reading in readings:
+        if not isinstance(reading, dict):
+            reading = {(): reading}
+        for key, value in reading.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames=labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        bucket_i = bisect_left(self.buckets, value)
+        with self._lock:
+            # [count per bucket (the last one is +Inf), sum, count]
+            counts = self._values.get(key)
+            if counts is None:
+                counts = [[0]*(len(self.buckets) + 1), 0., 0]
+                self._values[key] = counts
+            counts[0][bucket_i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(counts[0]), counts[1], counts[2]) for key, counts in self._values.items()]
+        for key, bucket_counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", key, (("le", le),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+class Registry:
+    """
+    Metrics of this process, by name; asking for an existing metric returns it
+    """
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, cls, name, *args, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self.__metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} is already a {metric.TYPE}")
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.__get(Counter, name, help_text, labelnames=labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), func=None):
+        gauge = self.__get(Gauge, name, help_text, labelnames=labelnames)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.__get(Histogram, name, help_text, labelnames=labelnames, buckets=buckets)
+
+    def metrics(self):
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+        return "\n".join(metric.render() for metric in self.metrics()) + "\n"
+
+    def summary(self):
+        """
+        Returns a short, human-readable line per sample (histograms are summarized by
+        their sum and count)
+        """
+        lines = []
+        for metric in self.metrics():
+            for suffix, key, extra, value in metric.samples():
+                if suffix == "_bucket":
+                    continue
+                labels = format_labels(metric.labelnames, key, extra)
+                lines.append(f"{metric.name}{suffix}{labels} = {value:g}")
+        return lines
+
+    def dump(self, path):
+        """
+        Write every metric to the given path in the Prometheus text format; the file
+        is replaced atomically, so that it can be scraped (e.g. by node_exporter's
+        textfile collector) at any time
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".prom")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+REGISTRY = Registry()
+
+FUNCTION_WALL_TIME = REGISTRY.histogram(
+    "function_wall_seconds", "Real (wall clock) time spent per call", labelnames=("function",)
+)
+FUNCTION_CPU_TIME = REGISTRY.histogram(
+    "function_cpu_seconds", "CPU time spent per call (by the calling thread)",
+    labelnames=("function",)
+)
+
+def timed(func):
+    """
+    Record the wall clock and CPU time of every call to func
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            FUNCTION_CPU_TIME.observe(time.thread_time() - cpu_start, function=name)
+            FUNCTION_WALL_TIME.observe(time.perf_counter() - wall_start, function=name)
+
+    return timed_func
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread records the call stack of every other
+    thread every interval seconds; the samples can be written out as collapsed stacks
+    (one "outer;...;inner count" line per distinct stack), as read by flamegraph.pl
+    and speedscope
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.n_samples = 0
+        self.__stacks = StackCounter()
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    @staticmethod
+    def __frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def __sample(self):
+        own_id = threading.get_ident()
+        while not self.__stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.__frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.__stacks[";".join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def start(self):
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__sample, name="SamplingProfiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.__stacks.most_common())
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+def instrument_api(api, app_name, profile=False):
+    """
+    Count and time the requests served by a FastAPI app, and add the GET /metrics
+    (Prometheus text format) endpoint to it, as well as GET /profile (collapsed stacks
+    sampled for the given number of seconds) if profile is set
+    """
+    from fastapi import Request, Query
+    from fastapi.responses import PlainTextResponse
+
+    http_requests = REGISTRY.counter(
+        "http_requests_total", "HTTP requests served",
+        labelnames=("app", "method", "path", "status")
+    )
+    http_request_time = REGISTRY.histogram(
+        "http_request_duration_seconds", "Real time spent serving HTTP requests",
+        labelnames=("app", "method", "path")
+    )
+
+    @api.middleware("http")
+    async def count_requests(request: Request, call_next):
+        t_start = time.perf_counter()
+        response = await call_next(request)
+        # Label by route template rather than by URL, so connection IDs do not each
+        # make a new time series
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        http_request_time.observe(
+            time.perf_counter() - t_start, app=app_name, method=request.method, path=path
+        )
+        http_requests.inc(
+            app=app_name, method=request.method, path=path, status=response.status_code
+        )
+        return response
+
+    @api.get("/metrics", response_class=PlainTextResponse)
+    def get_metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    if not profile:
+        return
+
+    @api.get("/profile", response_class=PlainTextResponse)
+    def get_profile(
+        seconds: float = Query(5., gt=0., le=300.), 
+        interval: float = Query(0.005, ge=0.001, le=1.)
+    ):
+        profiler = SamplingProfiler(interval=interval)
+        profiler.start()
+        time.sleep(seconds)
+        profiler.stop()
+        return profiler.collapsed()
@@ -1,25 +1,168 @@
 import time
 import yaml
 import logging
+import itertools
+from heapq import heappush, heappop
 
-TIME_DILATION = None
+from utils.metrics import timed
 
-def get_time_dilation():
-    global TIME_DILATION
-    if not TIME_DILATION:
-        with open("config.yaml", "r") as f_in:
+CLOCK = None
+SIMULATION = None
+
+class Clock:
+    """
+    Virtual clock: virtual time runs time_dilation times as fast as the monotonic 
+    clock, starting from time_dilation times the wall clock time at which the clock
+    was created, so separate processes agree on the time (to within the precision of 
+    that one reading) but their clocks never jump with adjustments to the wall clock.
+    The clock can be paused and resumed, and its dilation changed, without jumps.
+    """
+    def __init__(self, time_dilation=1.0):
+        self.__time_dilation = time_dilation
+        # Virtual time = t_anchor + rate*(monotonic time - ns_anchor); replaced as a
+        # whole so that readers in other threads always see a consistent anchor
+        ns_anchor = time.monotonic_ns()
+        self.__anchor = (ns_anchor, time_dilation*(time.time_ns()/10**9), time_dilation)
+
+    @classmethod
+    def from_config(cls, config_yaml="config.yaml"):
+        with open(config_yaml, "r") as f_in:
             vsnet_config = yaml.safe_load(f_in).get("vsnet", {})
-            TIME_DILATION = vsnet_config.get("time_dilation", 1.0)
+        return cls(vsnet_config.get("time_dilation", 1.0))
+
+    @property
+    def time_dilation(self):
+        return self.__time_dilation
+
+    @property
+    def is_paused(self):
+        return self.__anchor[2] == 0.
+
+    def now(self):
+        ns_anchor, t_anchor, rate = self.__anchor
+        return t_anchor + rate*((time.monotonic_ns() - ns_anchor)/10**9)
 
-    return TIME_DILATION
+    def __reanchor(self, rate):
+        ns_anchor = time.monotonic_ns()
+        old_ns_anchor, t_anchor, old_rate = self.__anchor
+        t_anchor += old_rate*((ns_anchor - old_ns_anchor)/10**9)
+        self.__anchor = (ns_anchor, t_anchor, rate)
+
+    def pause(self):
+        """
+        Stop the virtual clock
+        """
+        self.__reanchor(0.)
+
+    def resume(self):
+        self.__reanchor(self.__time_dilation)
+
+    def set_time_dilation(self, time_dilation):
+        """
+        Change the rate of the virtual clock from now on (the clock does not jump)
+        """
+        self.__time_dilation = time_dilation
+        if not self.is_paused:
+            self.__reanchor(time_dilation)
+
+def get_clock():
+    """
+    Returns the virtual clock, configured from config.yaml the first time it is used
+    """
+    global CLOCK
+    if CLOCK is None:
+        CLOCK = Clock.from_config()
+    return CLOCK
+
+def use_clock(clock):
+    global CLOCK
+    CLOCK = clock
+
+def get_time_dilation():
+    return get_clock().time_dilation
+
+class Simulation:
+    """
+    Discrete-event simulation: callbacks are scheduled at virtual times in a priority
+    queue, and the virtual clock jumps straight from one event to the next instead of
+    following the wall clock. Events scheduled at the same time run in the order in
+    which they were scheduled, so runs are deterministic.
+    """
+    def __init__(self, t_start=0., time_dilation=1.0):
+        self.time = t_start
+        # Not used by the simulation itself; lets a Simulation stand in for a Clock
+        self.time_dilation = time_dilation
+        self.n_events = 0
+        self.__queue = []
+        self.__counter = itertools.count()
+        self.__cancelled = set()
+
+    def now(self):
+        return self.time
+
+    def schedule(self, t, callback, *args):
+        """
+        Schedule callback(*args) at virtual time t; returns a handle for cancel()
+        """
+        if t < self.time:
+            raise ValueError(f"cannot schedule event at {t} (before now: {self.time})")
+        handle = next(self.__counter)
+        heappush(self.__queue, (t, handle, callback, args))
+        return handle
+
+    def schedule_in(self, delay, callback, *args):
+        return self.schedule(self.time + delay, callback, *args)
+
+    def cancel(self, handle):
+        self.__cancelled.add(handle)
+
+    def step(self):
+        """
+        Advance the clock to the next event and run it; returns False if no events
+        are left
+        """
+        while len(self.__queue) > 0:
+            t, handle, callback, args = heappop(self.__queue)
+            if handle in self.__cancelled:
+                self.__cancelled.remove(handle)
+                continue
+            self.time = t
+            self.n_events += 1
+            callback(*args)
+            return True
+
+        return False
+
+    def run(self, until=None):
+        while len(self.__queue) > 0:
+            if until is not None and self.__queue[0][0] > until:
+                self.time = until
+                break
+            self.step()
+
+def use_simulation(simulation):
+    """
+    Drive now() with the given Simulation (or the wall clock if None)
+    """
+    global SIMULATION
+    SIMULATION = simulation
 
 def now():
-    return get_time_dilation()*(time.time_ns()/10**9)
+    if SIMULATION:
+        return SIMULATION.time
+    else:
+        return (CLOCK or get_clock()).now()
 
 def time_this(func):
+    """
+    Log the virtual time taken by every call to func, and record its real (wall clock
+    and CPU) time in the function_wall_seconds and function_cpu_seconds metrics
+    """
+    recorded_func = timed(func)
+
     def timed_func(*args, **kwargs):
         start_time = now()
-        result = func(*args, **kwargs)
+        result = recorded_func(*args, **kwargs)
         end_time = now()
         logging.debug(f"Ran {func.__name__} in {end_time - start_time} virtual seconds")
         return result